@@ -1,14 +1,18 @@
 import os
-import subprocess
 import tempfile
 
+from .resources import default_log, available_cpus, file_size, workspace
+
 
 class FastAni:
     fields = [
         "query_fp", "ref_fp", "ani", "fragments_aligned", "fragments_total"]
     field_types = [str, str, float, int, int]
 
-    def __init__(self, work_dir=None):
+    def __init__(self, work_dir=None, resource_log=None):
+        if resource_log is None:
+            resource_log = default_log
+        self.resource_log = resource_log
         if work_dir is not None:
             if not os.path.exists(work_dir):
                 os.makedirs(work_dir)
@@ -19,28 +23,34 @@ class FastAni:
 
     def run(self, query_genome_fp, subject_genome_fps, threads=None):
         if threads is None:
-            # https://docs.python.org/3/library/multiprocessing.html#multiprocessing.cpu_count
-            threads = len(os.sched_getaffinity(0))
-
-        reflist_fp = os.path.join(self.work_dir, "ref_list.txt")
-        with open(reflist_fp, "w") as f:
-            for subject_fp in subject_genome_fps:
-                f.write(subject_fp)
-                f.write("\n")
-        ani_fp = os.path.join(self.work_dir, "ani.txt")
-
-        subprocess.check_call([
-            "fastANI",
-            "--query", query_genome_fp,
-            "--refList", reflist_fp,
-            "--output", ani_fp,
-            "--threads", str(threads),
-            "--minFrag", "1",
-        ])
-
-        with open(ani_fp) as f:
-            for ani_result in self.parse(f):
-                yield ani_result
+            threads = available_cpus()
+        subject_genome_fps = list(subject_genome_fps)
+
+        with workspace(self.work_dir) as work_dir:
+            reflist_fp = os.path.join(work_dir, "ref_list.txt")
+            with open(reflist_fp, "w") as f:
+                for subject_fp in subject_genome_fps:
+                    f.write(subject_fp)
+                    f.write("\n")
+            ani_fp = os.path.join(work_dir, "ani.txt")
+
+            args = [
+                "fastANI",
+                "--query", query_genome_fp,
+                "--refList", reflist_fp,
+                "--output", ani_fp,
+                "--threads", str(threads),
+                "--minFrag", "1",
+            ]
+            self.resource_log.run(
+                args, threads=threads,
+                input_size=file_size(query_genome_fp, *subject_genome_fps))
+
+            with open(ani_fp) as f:
+                ani_results = list(self.parse(f))
+
+        for ani_result in ani_results:
+            yield ani_result
 
     @classmethod
     def parse(cls, f):
@@ -1,95 +1,317 @@
+import concurrent.futures
+import os
+import random
+
 from .ani import FastAni
-from .search import Vsearch, limit_hits
+from .resources import default_log, file_size
+from .search import Vsearch, HitTable, sample_hits, aggregate_hits
 
 class StackebrandtApp:
-    def __init__(self, db, search_dir=None, ani_dir=None):
+    def __init__(
+            self, db, search_dir=None, ani_dir=None, resource_log=None,
+            search_cache_dir=None):
         self.db = db
-        self.search_app = Vsearch(search_dir)
-        self.ani_app = FastAni(ani_dir)
+        if resource_log is None:
+            resource_log = default_log
+        self.resource_log = resource_log
+        self.search_app = Vsearch(search_dir, resource_log, search_cache_dir)
+        self.ani_app = FastAni(ani_dir, resource_log)
         self.min_pctid = 90.0
         self.max_hits = 100000
         self.threads = None
         self.multi_stage_search = False
         self.max_unique_pctid = 100
+        self.pctid_bin_width = 0.1
+        self.max_subjects = None
+        self.max_downloads = None
+        self.copy_aggregation = None
+        self.autotune_threads = False
+        self.compact_alignments = False
+        self.num_shards = None
+        self.shard_workers = None
+        self.taxon_rank = None
+        self.taxon_ids = None
 
-    def run(self, query_accession):
-        hits = self.search(query_accession)
+    def run(self, query_accession, rng=None):
+        hits = self.search(query_accession, rng)
         if not hits:
             return
 
-        seqids = [hit["sseqid"] for hit in hits]
+        seqids = hits.column("sseqid")
         accessions = [self.db.seqid_accessions[s] for s in seqids]
         ani_results = self.calculate_ani(query_accession, accessions)
 
-        query_seqid = hits[0]['qseqid']
         # ANI results are guaranteed to be same order and length as hits
-        for hit, ani_result in zip(hits, ani_results):
-            seqid = hit["sseqid"]
-            accession = self.db.seqid_accessions[seqid]
+        for idx, ani_result in enumerate(ani_results):
             yield AppResult(
-                query_accession, accession, query_seqid, seqid,
-                hit, ani_result)
+                query_accession, accessions[idx], hits.qseqid(idx),
+                seqids[idx], hits[idx], ani_result)
+
+    def run_many(self, query_accessions, max_workers=None, seed=None):
+        # Each query gets its own random number generator if a seed is
+        # given, so results do not depend on how the threads are scheduled
+        def run_one(query_accession):
+            rng = None if seed is None else random.Random(seed)
+            return list(self.run(query_accession, rng))
+
+        query_accessions = list(query_accessions)
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            results = executor.map(run_one, query_accessions)
+            return dict(zip(query_accessions, results))
+
+    def plan(self, query_accession, rng=None, max_workers=8):
+        # Runs the search and sampling stages of run(), but only takes stock
+        # of the genomes needed for ANI. Sizes of genomes to download are
+        # requested from the server in several threads.
+        hits = self.search(query_accession, rng)
+        subject_accessions = [
+            self.hit_accession(seqid) for seqid in hits.column("sseqid")]
+        plan = QueryPlan(query_accession, hits, subject_accessions)
+        download_accessions = []
+        for accession in plan.genomes:
+            assembly = self.db.assemblies[accession]
+            plan.genome_urls[accession] = assembly.genome_url
+            if self.db.has_genome(accession):
+                plan.genome_sizes[accession] = file_size(
+                    self.db.genome_fp(assembly))
+            else:
+                download_accessions.append(accession)
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            sizes = executor.map(
+                self.db.genome_download_size, download_accessions)
+            plan.download_sizes = dict(zip(download_accessions, sizes))
+        plan.fingerprints = self.db.load_fingerprints()
+        plan.ani_cpu_rate = self.resource_log.cpu_rate("fastANI")
+        return plan
 
-    def search(self, query_accession):
+    def search(self, query_accession, rng=None):
         if self.multi_stage_search:
             hits = self.exhaustive_search(query_accession)
         else:
             hits = self.regular_search(query_accession)
-        hits = limit_hits(hits, self.max_unique_pctid)
-        return list(hits)
+        if self.copy_aggregation is not None:
+            hits = aggregate_hits(
+                hits, self.hit_accession, self.copy_aggregation)
+        hits = sample_hits(
+            hits, self.hit_accession, bin_width=self.pctid_bin_width,
+            max_per_bin=self.max_unique_pctid, max_subjects=self.max_subjects,
+            max_downloads=self.max_downloads, is_cached=self.db.has_genome,
+            rng=rng)
+        return hits
+
+    def hit_accession(self, seqid):
+        return self.db.seqid_accessions[seqid]
 
     def calculate_ani(self, query_accession, subject_accessions):
         query_fp = self.db.collect_genome(query_accession)
 
+        # Subjects with identical genome sequence share one ANI computation
         unique_subjects = set(subject_accessions)
-        subject_fps = {
-            self.db.collect_genome(a): a for a in unique_subjects}
+        subject_fingerprints = {}
+        fingerprint_fps = {}
+        for accession in sorted(unique_subjects):
+            subject_fp = self.db.collect_genome(accession)
+            fingerprint = self.db.genome_fingerprint(accession)
+            subject_fingerprints[accession] = fingerprint
+            fingerprint_fps.setdefault(fingerprint, subject_fp)
+        fp_fingerprints = {fp: fg for fg, fp in fingerprint_fps.items()}
 
+        threads = self.tool_threads(
+            "fastANI", file_size(query_fp, *fingerprint_fps.values()))
         ani_results = self.ani_app.run(
-            query_fp, subject_fps.keys(), threads=self.threads)
+            query_fp, fingerprint_fps.values(), threads=threads)
 
-        subject_results = {s: None for s in unique_subjects}
+        fingerprint_results = {}
         for res in ani_results:
-            subject_fp = res["ref_fp"]
-            subject = subject_fps[subject_fp]
-            subject_results[subject] = res
+            fingerprint = fp_fingerprints[res["ref_fp"]]
+            fingerprint_results[fingerprint] = res
+
+        subject_results = {}
+        for accession in unique_subjects:
+            res = fingerprint_results.get(subject_fingerprints[accession])
+            if res is not None:
+                subject_fp = self.db.genome_fp(self.db.assemblies[accession])
+                res = dict(res, ref_fp=subject_fp)
+            subject_results[accession] = res
 
         return [subject_results[a] for a in subject_accessions]
 
+    def search_taxa(self, query_accession):
+        # Subjects are limited to these taxa, if a scope is given
+        if self.taxon_ids:
+            return self.taxon_ids
+        if self.taxon_rank:
+            return self.db.rank_taxids(query_accession, self.taxon_rank)
+        return None
+
+    def tool_threads(self, tool, input_size):
+        if not self.autotune_threads:
+            return self.threads
+        return self.resource_log.choose_threads(
+            tool, input_size, max_threads=self.threads)
+
     def regular_search(self, query_accession, subject_fp=None):
         clear_db = subject_fp is not None
+        search_fasta_fp = self.db.search_fasta_fp()
         if subject_fp is None:
-            subject_fp = self.db.ssu_fasta_fp
-        query_seqids = self.db.accession_seqids[query_accession]
-        query_seqid = query_seqids[0]
-        query_seq = self.db.seqs[query_seqid]
-        hits = self.search_app.search_once(
-            query_seqid, query_seq, subject_fp, min_pctid=self.min_pctid,
-            max_hits=self.max_hits, threads=self.threads, clear_db=clear_db)
-        hits = [hit for hit in hits if hit['sseqid'] not in query_seqids]
-        return hits
+            taxa = self.search_taxa(query_accession)
+            if taxa is None:
+                subject_fp = search_fasta_fp
+            else:
+                subject_fp = self.db.taxon_db(taxa)
+        if os.path.getsize(subject_fp) == 0:
+            return HitTable()
+        query_seqs = self.db.query_seqs(query_accession)
+        query_seqids = [seqid for seqid, seq in query_seqs]
+        if self.copy_aggregation is None:
+            query_seqs = query_seqs[:1]
+        query_size = sum(len(seq) for seqid, seq in query_seqs)
+        threads = self.tool_threads(
+            "vsearch", query_size + file_size(subject_fp))
+        sharded = self.num_shards and (subject_fp == search_fasta_fp)
+        if sharded and not clear_db:
+            shard_fps = self.db.shard_fps(self.num_shards)
+            hits = self.search_app.search_sharded(
+                query_seqs, subject_fp, shard_fps, min_pctid=self.min_pctid,
+                max_hits=self.max_hits, threads=threads,
+                compact=self.compact_alignments,
+                max_workers=self.shard_workers)
+        else:
+            hits = self.search_app.search_many(
+                query_seqs, subject_fp, min_pctid=self.min_pctid,
+                max_hits=self.max_hits, threads=threads, clear_db=clear_db,
+                subject_seqs=self.db.seqs if self.compact_alignments else None)
+        query_seqids = set(query_seqids)
+        idxs = [
+            idx for idx, seqid in enumerate(hits.column("sseqid"))
+            if seqid not in query_seqids]
+        return hits.subset(idxs)
 
     def exhaustive_search(self, query_accession):
-        already_found = set()
-
         hits = self.regular_search(query_accession)
-        for hit in hits:
-            already_found.add(hit['sseqid'])
-            yield hit
-
-        subject_fp = self.search_app.filtered_fp
-        for trial in range(10):
-            print("Follow-up search, trial", trial + 1)
-            self.db.save_filtered_seqs(subject_fp, already_found)
-            hits = self.regular_search(query_accession, subject_fp)
-            n_hits = 0
-            for hit in hits:
-                n_hits += 1
-                already_found.add(hit['sseqid'])
-                yield hit
-            if n_hits == 0:
-                return
+        already_found = set(hits.column("sseqid"))
+
+        taxa = self.search_taxa(query_accession)
+        seqids = None
+        if taxa is not None:
+            seqids = self.db.taxon_seqids(taxa)
+
+        with self.search_app.workspace() as work_dir:
+            subject_fp = os.path.join(work_dir, "filtered_subject.fasta")
+            for trial in range(10):
+                print("Follow-up search, trial", trial + 1)
+                self.db.save_filtered_seqs(subject_fp, already_found, seqids)
+                trial_hits = self.regular_search(query_accession, subject_fp)
+                hits.extend(trial_hits)
+                already_found.update(trial_hits.column("sseqid"))
+                if len(trial_hits) == 0:
+                    return hits
         print("Exhausted 10 search trials")
+        return hits
+
+
+class QueryPlan:
+    # Typical ratio of uncompressed to gzipped size for genome FASTA files
+    compression_ratio = 3.3
+
+    def __init__(self, query_accession, hits, subject_accessions):
+        self.query_accession = query_accession
+        self.hits = hits
+        self.subject_accessions = subject_accessions
+        self.genomes = []
+        if subject_accessions:
+            subjects = set(subject_accessions) - {query_accession}
+            self.genomes = [query_accession] + sorted(subjects)
+        self.genome_urls = {}
+        self.genome_sizes = {}
+        self.download_sizes = {}
+        self.fingerprints = {}
+        self.ani_cpu_rate = None
+
+    @property
+    def cached_genomes(self):
+        return [a for a in self.genomes if a in self.genome_sizes]
+
+    @property
+    def prefetch_genomes(self):
+        return [a for a in self.genomes if a not in self.genome_sizes]
+
+    def cache_hit_ratio(self):
+        if not self.genomes:
+            return None
+        return len(self.cached_genomes) / len(self.genomes)
+
+    def download_bytes(self):
+        sizes = [self.download_sizes.get(a) for a in self.prefetch_genomes]
+        return sum(size for size in sizes if size is not None)
+
+    def unknown_sizes(self):
+        return [a for a in self.prefetch_genomes
+                if self.download_sizes.get(a) is None]
+
+    def ani_subjects(self):
+        # Subjects with identical genomes share one comparison, as in
+        # calculate_ani. Only genomes fingerprinted before are recognized.
+        subjects = {}
+        for accession in sorted(set(self.subject_accessions)):
+            key = self.fingerprints.get(accession, accession)
+            subjects.setdefault(key, accession)
+        return list(subjects.values())
+
+    def genome_size(self, accession):
+        if accession in self.genome_sizes:
+            return self.genome_sizes[accession]
+        download_size = self.download_sizes.get(accession)
+        if download_size is None:
+            return None
+        return int(download_size * self.compression_ratio)
+
+    def ani_input_bytes(self):
+        accessions = [self.query_accession] + self.ani_subjects()
+        sizes = [self.genome_size(a) for a in accessions]
+        return sum(size for size in sizes if size is not None)
+
+    def ani_cpu_time(self):
+        if self.ani_cpu_rate is None:
+            return None
+        return self.ani_cpu_rate * self.ani_input_bytes()
+
+    def format_summary(self):
+        lines = [
+            "Query: {0}".format(self.query_accession),
+            "16S hits: {0}".format(len(self.hits)),
+        ]
+        if not self.genomes:
+            lines.append("No genomes needed for ANI")
+            return lines
+        lines.append("Genomes cached: {0} of {1} ({2:.0%})".format(
+            len(self.cached_genomes), len(self.genomes),
+            self.cache_hit_ratio()))
+        download_line = "Genomes to download: {0}, {1:.1f} MB".format(
+            len(self.prefetch_genomes), self.download_bytes() / 1e6)
+        if self.unknown_sizes():
+            download_line += " ({0} of unknown size)".format(
+                len(self.unknown_sizes()))
+        lines.append(download_line)
+        ani_line = "fastANI: {0} comparisons, {1:.1f} MB of genomes".format(
+            len(self.ani_subjects()), self.ani_input_bytes() / 1e6)
+        if self.ani_cpu_time() is not None:
+            ani_line += ", about {0:.0f} s CPU".format(self.ani_cpu_time())
+        lines.append(ani_line)
+        return lines
+
+    def format_prefetch(self):
+        for accession in self.prefetch_genomes:
+            yield "{0}\t{1}\n".format(accession, self.genome_urls[accession])
+
+
+def parse_prefetch(f):
+    for line in f:
+        line = line.strip()
+        if line.startswith("#") or (line == ""):
+            continue
+        accession, sep, genome_url = line.partition("\t")
+        yield accession
 
 
 class AppResult:
@@ -118,7 +340,7 @@ class AppResult:
             vals = [fcn(tok) for tok, fcn in zip(toks, cls.output_types)]
             yield dict(zip(cls.output_fields, vals))
 
-    def format_output(self):
+    def as_dict(self):
         pident = self.hit["pident"]
         if self.ani_result is None:
             ani = ""
@@ -128,9 +350,20 @@ class AppResult:
             ani = self.ani_result["ani"]
             fragments_aligned = self.ani_result["fragments_aligned"]
             fragments_total = self.ani_result["fragments_total"]
-        pident_format = round(float(pident), 2)
-        return "{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\t{7}\n".format(
-            self.query_accession, self.subject_accession,
-            self.query_seqid, self.subject_seqid,
-            pident_format, ani, fragments_aligned, fragments_total,
-        )
+        return {
+            "query_assembly": self.query_accession,
+            "subject_assembly": self.subject_accession,
+            "query_seqid": self.query_seqid,
+            "subject_seqid": self.subject_seqid,
+            "pctid": round(float(pident), 2),
+            "ani": ani,
+            "fragments_aligned": fragments_aligned,
+            "fragments_total": fragments_total,
+        }
+
+    def format_output(self):
+        return self.format_dict(self.as_dict())
+
+    @classmethod
+    def format_dict(cls, vals):
+        return "\t".join(str(vals[field]) for field in cls.output_fields) + "\n"
@@ -1,8 +1,31 @@
 import argparse
+import concurrent.futures
+import os
 import random
 
 from .refseq import RefSeq
-from .application import StackebrandtApp, AppResult
+from .application import StackebrandtApp, AppResult, parse_prefetch
+from .resources import default_log
+from .search import AGGREGATION_METHODS
+
+# Command-line options that are copied to attributes of StackebrandtApp
+QUERY_OPTIONS = {
+    "min_pctid": "min_pctid",
+    "max_hits": "max_hits",
+    "max_unique_pctid": "max_unique_pctid",
+    "pctid_bin_width": "pctid_bin_width",
+    "max_subjects": "max_subjects",
+    "max_downloads": "max_downloads",
+    "num_threads": "threads",
+    "multi_stage_search": "multi_stage_search",
+    "copy_aggregation": "copy_aggregation",
+    "autotune_threads": "autotune_threads",
+    "compact_alignments": "compact_alignments",
+    "num_shards": "num_shards",
+    "shard_workers": "shard_workers",
+    "taxon_rank": "taxon_rank",
+    "taxon_ids": "taxon_ids",
+}
 
 def main(argv=None):
     p = argparse.ArgumentParser()
@@ -15,12 +38,85 @@ def main(argv=None):
         help="Output file (default: created from assembly accession)",
     )
     p.add_argument(
-        "--min-pctid", type=float, default=90.0,
-        help="Minimum 16S percent ID (default: %(default)s)",
+        "--plan", action="store_true",
+        help=(
+            "Run the 16S search and report the genomes needed for ANI, "
+            "without downloading genomes or running fastANI"),
     )
     p.add_argument(
-        "--max-n", type=int, default=5,
-        help="Maximum number of Ns in 16S sequences (default: %(default)s)",
+        "--prefetch-file",
+        help=(
+            "With --plan, write the genomes to download to this file, for "
+            "use with stackebrandtcurve-prefetch (default: not written)"),
+    )
+    add_query_arguments(p)
+    add_database_arguments(p)
+    args = p.parse_args(argv)
+
+    if args.output_file is None:
+        args.output_file = default_output_file(args.assembly_accession)
+    random.seed(args.seed)
+    if args.resource_log is not None:
+        default_log.open(args.resource_log)
+
+    db = RefSeq(
+        args.data_dir, args.max_n, args.assembly_filter, args.taxonomy_dir,
+        args.max_ambiguous, args.min_length)
+    db.load(args.refresh_summary)
+
+    app = StackebrandtApp(
+        db, args.search_dir, args.ani_dir,
+        search_cache_dir=search_cache_dir(args))
+    configure_app(app, query_options(args))
+
+    if args.plan:
+        plan = app.plan(args.assembly_accession)
+        for line in plan.format_summary():
+            print(line)
+        if args.prefetch_file is not None:
+            with open(args.prefetch_file, "w") as f:
+                for line in plan.format_prefetch():
+                    f.write(line)
+        return
+
+    results = app.run(args.assembly_accession)
+
+    with open(args.output_file, "w") as f:
+        f.write(AppResult.output_header)
+        for result in results:
+            f.write(result.format_output())
+
+    for line in default_log.format_summary():
+        print(line)
+
+def main_prefetch(argv=None):
+    p = argparse.ArgumentParser(
+        description="Download the genomes listed by stackebrandtcurve --plan")
+    p.add_argument(
+        "prefetch_file", type=argparse.FileType("r"),
+        help="List of genomes to download",
+    )
+    p.add_argument(
+        "--num-workers", type=int, default=4,
+        help="Number of simultaneous downloads (default: %(default)s)",
+    )
+    p.add_argument(
+        "--data-dir", default="refseq_data",
+        help="Data directory (default: refseq_data)",
+    )
+    args = p.parse_args(argv)
+
+    db = RefSeq(args.data_dir)
+    db.load_assemblies()
+    accessions = list(parse_prefetch(args.prefetch_file))
+    with concurrent.futures.ThreadPoolExecutor(args.num_workers) as executor:
+        for genome_fp in executor.map(db.collect_genome, accessions):
+            pass
+
+def add_query_arguments(p):
+    p.add_argument(
+        "--min-pctid", type=float, default=90.0,
+        help="Minimum 16S percent ID (default: %(default)s)",
     )
     p.add_argument(
         "--max-hits", type=int, default=100000,
@@ -29,13 +125,33 @@ def main(argv=None):
     p.add_argument(
         "--max-unique-pctid", type=int, default=100,
         help=(
-            "Maximum number of ANI comparisons for each unique value of 16S "
+            "Maximum number of ANI comparisons for each bin of 16S "
             "percent ID (default: %(default)s)"),
     )
+    p.add_argument(
+        "--pctid-bin-width", type=float, default=0.1,
+        help="Width of 16S percent ID bins (default: %(default)s)",
+    )
+    p.add_argument(
+        "--max-subjects", type=int,
+        help="Maximum number of subject genomes for ANI (default: no limit)",
+    )
+    p.add_argument(
+        "--max-downloads", type=int,
+        help=(
+            "Maximum number of subject genomes to download, genomes already "
+            "on disk are preferred (default: no limit)"),
+    )
     p.add_argument(
         "--num-threads", type=int,
         help="Number of threads for 16S percent ID (default: use all CPUs)",
     )
+    p.add_argument(
+        "--autotune-threads", action="store_true",
+        help=(
+            "Choose the number of threads for vsearch and fastANI from "
+            "earlier runs in the resource log, up to --num-threads"),
+    )
     p.add_argument(
         "--seed", type=int, default=42,
         help="Random number seed (default: %(default)s)",
@@ -44,6 +160,81 @@ def main(argv=None):
         "--multi-stage-search", action="store_true",
         help="Conduct exhaustive 16S search in several stages",
     )
+    p.add_argument(
+        "--compact-alignments", action="store_true",
+        help=(
+            "Have vsearch report alignments in compact form, and score them "
+            "against the 16S sequences in memory"),
+    )
+    p.add_argument(
+        "--num-shards", type=int,
+        help=(
+            "Split the 16S database into this many shards and search them "
+            "in parallel processes (default: search the whole database)"),
+    )
+    p.add_argument(
+        "--shard-workers", type=int,
+        help="Number of processes for sharded search (default: one per shard)",
+    )
+    p.add_argument(
+        "--taxon-rank",
+        help=(
+            "Only search subjects in the same taxon of this rank as the "
+            "query, for example \"order\" or \"family\" (default: search "
+            "all subjects)"),
+    )
+    p.add_argument(
+        "--taxon-id", dest="taxon_ids", type=int, action="append",
+        help=(
+            "Only search subjects in this NCBI taxon. Can be given more than "
+            "once, and takes precedence over --taxon-rank (default: search "
+            "all subjects)"),
+    )
+    p.add_argument(
+        "--copy-aggregation", choices=AGGREGATION_METHODS,
+        help=(
+            "Search all 16S copies of the query and combine percent ID for "
+            "each subject assembly (default: search the first copy only)"),
+    )
+
+def add_database_arguments(p):
+    p.add_argument(
+        "--max-n", type=int, default=5,
+        help=(
+            "Maximum number of consecutive Ns in 16S sequences "
+            "(default: %(default)s)"),
+    )
+    p.add_argument(
+        "--max-ambiguous", type=int,
+        help=(
+            "Maximum number of ambiguous bases, N or other IUPAC codes, in "
+            "16S sequences (default: no limit)"),
+    )
+    p.add_argument(
+        "--min-length", type=int,
+        help="Minimum length of 16S sequences (default: no limit)",
+    )
+    p.add_argument(
+        "--assembly-filter", action="append",
+        help=(
+            "Only search assemblies with the given values in the assembly "
+            "summary, for example \"assembly_level=Complete Genome,"
+            "Chromosome\" or \"refseq_category!=na\". Can be given more "
+            "than once (default: all assemblies)"),
+    )
+    p.add_argument(
+        "--refresh-summary", action="store_true",
+        help=(
+            "Check NCBI for a newer assembly summary, and download it if it "
+            "has changed"),
+    )
+    p.add_argument(
+        "--taxonomy-dir",
+        help=(
+            "Directory with nodes.dmp and merged.dmp from the NCBI taxonomy "
+            "dump, downloaded if needed (default: taxonomy in the data "
+            "directory)"),
+    )
     p.add_argument(
         "--search-dir",
         help="Directory for search-related files (default: temp directory)",
@@ -56,26 +247,39 @@ def main(argv=None):
         "--data-dir", default="refseq_data",
         help="Data directory (default: refseq_data)",
     )
-    args = p.parse_args(argv)
-
-    if args.output_file is None:
-        args.output_file = "assembly_{0}_pctid_ani.txt".format(
-            args.assembly_accession)
-    random.seed(args.seed)
+    p.add_argument(
+        "--search-cache-dir",
+        help=(
+            "Directory for saved 16S search results (default: search_cache "
+            "in the data directory)"),
+    )
+    p.add_argument(
+        "--no-search-cache", action="store_true",
+        help="Always run the 16S search, do not use or save results",
+    )
+    p.add_argument(
+        "--resource-log",
+        help=(
+            "File recording the time and memory used by each external "
+            "program, appended to on each run (default: not saved)"),
+    )
 
-    db = RefSeq(args.data_dir, args.max_n)
-    db.load()
+def query_options(args):
+    return {opt: getattr(args, opt) for opt in QUERY_OPTIONS}
 
-    app = StackebrandtApp(db, args.search_dir, args.ani_dir)
-    app.min_pctid = args.min_pctid
-    app.max_hits = args.max_hits
-    app.max_unique_pctid = args.max_unique_pctid
-    app.threads = args.num_threads
-    app.multi_stage_search = args.multi_stage_search
+def configure_app(app, options):
+    for opt, val in options.items():
+        if opt not in QUERY_OPTIONS:
+            raise ValueError("Unknown option: {0}".format(opt))
+        setattr(app, QUERY_OPTIONS[opt], val)
+    return app
 
-    results = app.run(args.assembly_accession)
+def search_cache_dir(args):
+    if args.no_search_cache:
+        return None
+    if args.search_cache_dir is not None:
+        return args.search_cache_dir
+    return os.path.join(args.data_dir, "search_cache")
 
-    with open(args.output_file, "w") as f:
-        f.write(AppResult.output_header)
-        for result in results:
-            f.write(result.format_output())
+def default_output_file(assembly_accession):
+    return "assembly_{0}_pctid_ani.txt".format(assembly_accession)
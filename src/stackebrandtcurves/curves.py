@@ -0,0 +1,180 @@
+import argparse
+import collections
+import concurrent.futures
+import gzip
+import math
+import sys
+
+from .application import AppResult
+from .search import pctid_bin
+
+
+class CurveStats:
+    # Summary of ANI vs. 16S percent ID over any number of result files.
+    # Within each percent ID bin, ANI values are kept as a histogram, so
+    # memory depends on the number of bins and not on the number of pairs.
+    # Stats from different files can be merged in any order.
+    def __init__(
+            self, bin_width=0.1, ani_thresholds=(95.0,), ani_resolution=0.01):
+        self.bin_width = bin_width
+        self.ani_thresholds = list(ani_thresholds)
+        self.ani_resolution = ani_resolution
+        self.pairs = collections.Counter()
+        self.ani_hists = collections.defaultdict(collections.Counter)
+        self.above = {}
+
+    def add(self, pctid, ani=None):
+        bin_key = pctid_bin(pctid, self.bin_width)
+        self.pairs[bin_key] += 1
+        if ani is None:
+            return
+        self.ani_hists[bin_key][pctid_bin(ani, self.ani_resolution)] += 1
+        above = self.above.setdefault(
+            bin_key, [0] * len(self.ani_thresholds))
+        for idx, threshold in enumerate(self.ani_thresholds):
+            if ani >= threshold:
+                above[idx] += 1
+
+    def add_results(self, results):
+        for res in results:
+            self.add(res["pctid"], res.get("ani"))
+        return self
+
+    def merge(self, other):
+        if (other.bin_width != self.bin_width) or \
+           (other.ani_thresholds != self.ani_thresholds) or \
+           (other.ani_resolution != self.ani_resolution):
+            raise ValueError("Cannot merge stats with different bins")
+        self.pairs.update(other.pairs)
+        for bin_key, hist in other.ani_hists.items():
+            self.ani_hists[bin_key].update(hist)
+        for bin_key, other_above in other.above.items():
+            above = self.above.setdefault(
+                bin_key, [0] * len(self.ani_thresholds))
+            for idx, count in enumerate(other_above):
+                above[idx] += count
+        return self
+
+    def ani_quantile(self, bin_key, q):
+        # Nearest-rank quantile, to the ANI resolution
+        hist = self.ani_hists.get(bin_key)
+        if not hist:
+            return None
+        total = sum(hist.values())
+        # Small tolerance so that products like 0.1 * 30 give a whole rank
+        rank = max(1, math.ceil(q * total - 1e-9))
+        seen = 0
+        for ani_key in sorted(hist.keys()):
+            seen += hist[ani_key]
+            if seen >= rank:
+                return round(ani_key * self.ani_resolution, 4)
+
+    def rows(self, quantiles=(0.05, 0.25, 0.5, 0.75, 0.95)):
+        for bin_key in sorted(self.pairs.keys()):
+            ani_pairs = sum(self.ani_hists.get(bin_key, {}).values())
+            row = {
+                "pctid_bin": round(bin_key * self.bin_width, 4),
+                "pairs": self.pairs[bin_key],
+                "ani_pairs": ani_pairs,
+            }
+            for q in quantiles:
+                row[quantile_field(q)] = self.ani_quantile(bin_key, q)
+            above = self.above.get(bin_key)
+            for idx, threshold in enumerate(self.ani_thresholds):
+                frac = None
+                if ani_pairs:
+                    frac = round(above[idx] / ani_pairs, 4)
+                row[threshold_field(threshold)] = frac
+            yield row
+
+    def fields(self, quantiles=(0.05, 0.25, 0.5, 0.75, 0.95)):
+        return (
+            ["pctid_bin", "pairs", "ani_pairs"] +
+            [quantile_field(q) for q in quantiles] +
+            [threshold_field(t) for t in self.ani_thresholds])
+
+    def write(self, f, quantiles=(0.05, 0.25, 0.5, 0.75, 0.95)):
+        fields = self.fields(quantiles)
+        f.write("\t".join(fields) + "\n")
+        for row in self.rows(quantiles):
+            vals = ["" if row[field] is None else str(row[field])
+                    for field in fields]
+            f.write("\t".join(vals) + "\n")
+
+
+def quantile_field(q):
+    return "ani_q{0:g}".format(q * 100)
+
+
+def threshold_field(threshold):
+    return "frac_ani_{0:g}".format(threshold)
+
+
+def open_results(fp):
+    if fp.endswith(".gz"):
+        return gzip.open(fp, "rt")
+    return open(fp)
+
+
+def aggregate_file(fp, bin_width=0.1, ani_thresholds=(95.0,)):
+    stats = CurveStats(bin_width, ani_thresholds)
+    with open_results(fp) as f:
+        stats.add_results(AppResult.parse(f))
+    return stats
+
+
+def aggregate_files(
+        fps, bin_width=0.1, ani_thresholds=(95.0,), max_workers=None):
+    # Files are read in worker processes if max_workers is more than one
+    stats = CurveStats(bin_width, ani_thresholds)
+    if (max_workers is None) or (max_workers <= 1):
+        for fp in fps:
+            stats.merge(aggregate_file(fp, bin_width, ani_thresholds))
+        return stats
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+        futures = [
+            executor.submit(aggregate_file, fp, bin_width, ani_thresholds)
+            for fp in fps]
+        for future in concurrent.futures.as_completed(futures):
+            stats.merge(future.result())
+    return stats
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(
+        description=(
+            "Summarize ANI vs. 16S percent ID over many stackebrandtcurve "
+            "result files"))
+    p.add_argument(
+        "result_files", nargs="+",
+        help="Result files, optionally gzipped",
+    )
+    p.add_argument(
+        "--output-file", type=argparse.FileType("w"), default=sys.stdout,
+        help="Output file (default: standard output)",
+    )
+    p.add_argument(
+        "--pctid-bin-width", type=float, default=0.1,
+        help="Width of 16S percent ID bins (default: %(default)s)",
+    )
+    p.add_argument(
+        "--ani-thresholds", type=float, nargs="+", default=[95.0],
+        help=(
+            "Report the fraction of pairs with at least this ANI in each "
+            "bin (default: %(default)s)"),
+    )
+    p.add_argument(
+        "--quantiles", type=float, nargs="+",
+        default=[0.05, 0.25, 0.5, 0.75, 0.95],
+        help="Quantiles of ANI in each bin (default: %(default)s)",
+    )
+    p.add_argument(
+        "--num-workers", type=int, default=1,
+        help="Number of processes reading files (default: %(default)s)",
+    )
+    args = p.parse_args(argv)
+
+    stats = aggregate_files(
+        args.result_files, args.pctid_bin_width, args.ani_thresholds,
+        args.num_workers)
+    stats.write(args.output_file, args.quantiles)
@@ -0,0 +1,147 @@
+import array
+import collections
+import os
+import random
+import struct
+
+from .search import pctid_bin
+
+
+class PairTable:
+    # Sparse table of 16S sequence pairs, stored on disk in order of
+    # percent ID bin. Each pair is a fixed-size record, so that pairs in a
+    # bin can be sampled by seeking directly to them. Any parameters of the
+    # search that produced the pairs are saved with the bins, so that a
+    # table built with other parameters is not reused.
+    record = struct.Struct("<IId")
+
+    def __init__(self, prefix, bin_width=0.1, params=None):
+        self.prefix = prefix
+        self.bin_width = bin_width
+        if params is None:
+            params = {}
+        self.params = params
+        self.seqids = []
+        self.bins = {}
+
+    @property
+    def pairs_fp(self):
+        return self.prefix + ".pairs"
+
+    @property
+    def bins_fp(self):
+        return self.prefix + "_bins.txt"
+
+    @property
+    def seqids_fp(self):
+        return self.prefix + "_seqids.txt"
+
+    @property
+    def exists(self):
+        return os.path.exists(self.bins_fp)
+
+    @property
+    def header(self):
+        header = {"bin_width": str(self.bin_width)}
+        for name, val in self.params.items():
+            header[name] = str(val)
+        return header
+
+    def read_header(self):
+        header = {}
+        with open(self.bins_fp) as f:
+            for line in f:
+                if not line.startswith("# "):
+                    break
+                name, val = line[2:].rstrip("\n").split("\t")
+                header[name] = val
+        return header
+
+    @property
+    def is_current(self):
+        return self.exists and (self.read_header() == self.header)
+
+    def build(self, hits):
+        if self.exists:
+            os.remove(self.bins_fp)
+        seqid_idxs = {}
+        by_bin = collections.defaultdict(lambda: (
+            array.array("I"), array.array("I"), array.array("d")))
+        for hit in hits:
+            qidx = seqid_idxs.setdefault(hit["qseqid"], len(seqid_idxs))
+            sidx = seqid_idxs.setdefault(hit["sseqid"], len(seqid_idxs))
+            bin_key = pctid_bin(hit["pident"], self.bin_width)
+            qidxs, sidxs, pidents = by_bin[bin_key]
+            qidxs.append(qidx)
+            sidxs.append(sidx)
+            pidents.append(hit["pident"])
+
+        self.seqids = list(seqid_idxs.keys())
+        with open(self.seqids_fp, "w") as f:
+            for seqid in self.seqids:
+                f.write(seqid)
+                f.write("\n")
+
+        self.bins = {}
+        offset = 0
+        with open(self.pairs_fp, "wb") as f:
+            for bin_key in sorted(by_bin.keys()):
+                qidxs, sidxs, pidents = by_bin[bin_key]
+                for vals in zip(qidxs, sidxs, pidents):
+                    f.write(self.record.pack(*vals))
+                self.bins[bin_key] = (offset, len(pidents))
+                offset += len(pidents)
+
+        # Bins file is written last and marks the table as complete
+        with open(self.bins_fp, "w") as f:
+            for name, val in self.header.items():
+                f.write("# {0}\t{1}\n".format(name, val))
+            for bin_key, (offset, count) in sorted(self.bins.items()):
+                f.write("{0}\t{1}\t{2}\n".format(bin_key, offset, count))
+
+    def load(self):
+        if self.read_header() != self.header:
+            raise ValueError(
+                "Pair table {0} was built with other parameters".format(
+                    self.bins_fp))
+        with open(self.seqids_fp) as f:
+            self.seqids = [line.rstrip("\n") for line in f]
+        self.bins = {}
+        with open(self.bins_fp) as f:
+            for line in f:
+                if line.startswith("#"):
+                    continue
+                toks = line.rstrip("\n").split("\t")
+                self.bins[int(toks[0])] = (int(toks[1]), int(toks[2]))
+
+    def count(self, pctid):
+        bin_key = pctid_bin(pctid, self.bin_width)
+        offset, count = self.bins.get(bin_key, (0, 0))
+        return count
+
+    def get_pairs(self, pctid):
+        bin_key = pctid_bin(pctid, self.bin_width)
+        offset, count = self.bins.get(bin_key, (0, 0))
+        with open(self.pairs_fp, "rb") as f:
+            f.seek(offset * self.record.size)
+            data = f.read(count * self.record.size)
+        for vals in self.record.iter_unpack(data):
+            yield self.format_pair(*vals)
+
+    def sample(self, pctid):
+        bin_key = pctid_bin(pctid, self.bin_width)
+        offset, count = self.bins.get(bin_key, (0, 0))
+        if count == 0:
+            return None
+        idx = offset + random.randrange(count)
+        with open(self.pairs_fp, "rb") as f:
+            f.seek(idx * self.record.size)
+            vals = self.record.unpack(f.read(self.record.size))
+        return self.format_pair(*vals)
+
+    def format_pair(self, qidx, sidx, pident):
+        return {
+            "qseqid": self.seqids[qidx],
+            "sseqid": self.seqids[sidx],
+            "pident": pident,
+        }
@@ -1,49 +1,129 @@
 import collections
+import collections.abc
+import gzip
+import hashlib
 import io
+import mmap
 import os
 import re
 import shutil
-import subprocess
+import threading
+import urllib.error
 import urllib.request
 
+from .resources import default_log
+from .taxonomy import Taxonomy, extract_taxdump
+
 
 class RefSeq:
     summary_url = (
         "https://ftp.ncbi.nlm.nih.gov/genomes/refseq/"
         "bacteria/assembly_summary.txt"
         )
+    taxonomy_url = "https://ftp.ncbi.nlm.nih.gov/pub/taxonomy/taxdump.tar.gz"
 
-    def __init__(self, data_dir="refseq_data", max_n=5):
+    def __init__(
+            self, data_dir="refseq_data", max_n=5, assembly_filter=None,
+            taxonomy_dir=None, max_ambiguous=None, min_length=None):
         self.data_dir = data_dir
+        if taxonomy_dir is None:
+            taxonomy_dir = os.path.join(data_dir, "taxonomy")
+        self.taxonomy_dir = taxonomy_dir
         self.max_n = max_n
+        self.max_ambiguous = max_ambiguous
+        self.min_length = min_length
+        if isinstance(assembly_filter, str):
+            assembly_filter = [assembly_filter]
+        if (assembly_filter is not None) and \
+           not isinstance(assembly_filter, AssemblyFilter):
+            assembly_filter = AssemblyFilter.parse(assembly_filter)
+        self.assembly_filter = assembly_filter
         self.assemblies = {}
+        self.selected_accessions = set()
         self.seqs = {}
         self.accession_seqids = collections.defaultdict(list)
         self.seqid_accessions = {}
+        self.seq_stats = None
+        self.fingerprints = None
+        self.taxonomy = None
+        self._lock = threading.RLock()
+        self._accession_locks = collections.defaultdict(threading.RLock)
 
     @property
     def assembly_summary_fp(self):
         return os.path.join(self.data_dir, "assembly_summary.txt")
 
-    def download_summary(self):
+    @property
+    def summary_validators_fp(self):
+        return self.assembly_summary_fp + ".validators"
+
+    def download_summary(self, refresh=False):
+        for assembly in self.read_summary(refresh):
+            pass
+        return self.assembly_summary_fp
+
+    def read_summary(self, refresh=False):
+        # Assemblies are parsed while the summary is downloaded. The file is
+        # saved under a temporary name and moved into place once complete.
+        # On refresh, the download is skipped if the server reports that the
+        # summary has not changed.
         fp = self.assembly_summary_fp
-        if not os.path.exists(fp):
-            get_url(self.summary_url, fp)
-        return fp
-
-    def load(self):
-        self.load_assemblies()
+        resp = None
+        if refresh or not is_complete(fp):
+            validators = {}
+            if is_complete(fp):
+                validators = load_validators(self.summary_validators_fp)
+            resp = open_url(self.summary_url, conditional_headers(validators))
+        if resp is None:
+            with open(fp) as f:
+                yield from RefseqAssembly.parse(f)
+            return
+
+        print("Downloading", self.summary_url)
+        os.makedirs(self.data_dir, exist_ok=True)
+        temp_fp = temp_name(fp)
+        try:
+            with resp, open(temp_fp, "w", encoding="utf-8") as f:
+                yield from RefseqAssembly.parse(
+                    copy_lines(response_lines(resp, self.summary_url), f))
+        except BaseException:
+            if os.path.exists(temp_fp):
+                os.remove(temp_fp)
+            raise
+        os.replace(temp_fp, fp)
+        save_validators(self.summary_validators_fp, resp.headers)
+
+    def load(self, refresh_summary=False):
+        self.load_assemblies(refresh_summary)
         self.load_seqs()
 
-    def load_assemblies(self):
+    def load_assemblies(self, refresh_summary=False):
         if not os.path.exists(self.data_dir):
             os.makedirs(self.data_dir)
-        self.download_summary()
-        with open(self.assembly_summary_fp) as f:
-            for assembly in RefseqAssembly.parse(f):
-                self.assemblies[assembly.accession] = assembly
+        for assembly in self.read_summary(refresh_summary):
+            self.assemblies[assembly.accession] = assembly
+        self.select_assemblies()
         return self.assemblies
 
+    def select_assemblies(self):
+        # All assemblies stay available, so that a query can come from
+        # outside the selection. Only selected assemblies are searched.
+        if self.assembly_filter is None:
+            self.selected_accessions = set(self.assemblies.keys())
+        else:
+            index = self.index_assemblies(self.assembly_filter.fields)
+            self.selected_accessions = self.assembly_filter.select(
+                index, self.assemblies.keys())
+        return self.selected_accessions
+
+    def index_assemblies(self, fields):
+        index = {field: collections.defaultdict(set) for field in fields}
+        for accession, assembly in self.assemblies.items():
+            for field, field_index in index.items():
+                val = getattr(assembly, field, "")
+                field_index[val].add(accession)
+        return index
+
     def load_seqs(self):
         if os.path.exists(self.accession_fp):
             self.reload_seqs()
@@ -52,16 +132,42 @@ class RefSeq:
             self.save_seqs()
 
     def reload_seqs(self):
-        with open(self.ssu_fasta_fp) as f:
-            for seqid, seq in parse_fasta(f):
-                self.seqs[seqid] = seq
+        if not is_fresh(self.ssu_index_fp, self.ssu_fasta_fp):
+            index_fasta(self.ssu_fasta_fp, self.ssu_index_fp)
+        self.seqs = IndexedFasta(self.ssu_fasta_fp, self.ssu_index_fp)
         with open(self.accession_fp) as f:
             for seqid, accession in parse_accessions(f):
                 self.seqid_accessions[seqid] = accession
                 self.accession_seqids[accession].append(seqid)
 
+    def load_seq_stats(self):
+        # Stats are only read when sequences are screened after collection,
+        # so that loading the database does not read the stats table
+        with self._lock:
+            if self.seq_stats is None:
+                self.reload_seq_stats()
+            return self.seq_stats
+
+    def reload_seq_stats(self):
+        # Databases saved before stats were kept are screened once here
+        if is_fresh(self.ssu_stats_fp, self.ssu_fasta_fp):
+            with open(self.ssu_stats_fp) as f:
+                self.seq_stats = dict(parse_seq_stats(f))
+            return self.seq_stats
+        self.seq_stats = {}
+        seqids = list(self.seqs.keys())
+        for start in range(0, len(seqids), 10000):
+            batch = seqids[start:start + 10000]
+            batch_stats = screen_seqs(self.seqs[seqid] for seqid in batch)
+            self.seq_stats.update(zip(batch, batch_stats))
+        self.save_seq_stats()
+        return self.seq_stats
+
     def collect_seqs(self):
+        self.seq_stats = {}
         for accession in self.assemblies.keys():
+            if accession not in self.selected_accessions:
+                continue
             seqs = list(self.get_16S_seqs(accession))
             for seqid, seq in seqs:
                 self.accession_seqids[accession].append(seqid)
@@ -69,18 +175,185 @@ class RefSeq:
                 self.seqid_accessions[seqid] = accession
 
     def save_seqs(self):
-        with open(self.ssu_fasta_fp, "w") as f:
-            for seqid, seq in self.seqs.items():
-                f.write(">{0}\n{1}\n".format(seqid, seq))
+        write_indexed_fasta(
+            self.seqs.items(), self.ssu_fasta_fp, self.ssu_index_fp)
         with open(self.accession_fp, "w") as f:
             for seqid, accession in self.seqid_accessions.items():
                 f.write("{0}\t{1}\n".format(seqid, accession))
-
-    def save_filtered_seqs(self, fp, seen):
+        self.save_seq_stats()
+
+    def save_seq_stats(self):
+        with open(self.ssu_stats_fp, "w") as f:
+            f.write("\t".join(["seqid"] + SEQ_STATS_FIELDS) + "\n")
+            for seqid in self.seqs.keys():
+                stats = None
+                if self.seq_stats is not None:
+                    stats = self.seq_stats.get(seqid)
+                if stats is None:
+                    stats = seq_stats(self.seqs[seqid])
+                f.write("\t".join(str(x) for x in (seqid,) + stats) + "\n")
+
+    def query_seqs(self, accession):
+        seqids = self.accession_seqids.get(accession)
+        if seqids:
+            return [(seqid, self.seqs[seqid]) for seqid in seqids]
+        if accession in self.selected_accessions:
+            return []
+        # Query is not in the database, take its sequences from the source
+        return list(self.get_16S_seqs(accession))
+
+    def save_filtered_seqs(self, fp, seen, seqids=None):
+        if seqids is None:
+            seqids = self.screened_seqids()
         with open(fp, "w") as f:
-            for seqid, seq in self.seqs.items():
+            for seqid in seqids:
                 if seqid not in seen:
-                    f.write(">{0}\n{1}\n".format(seqid, seq))
+                    f.write(">{0}\n{1}\n".format(seqid, self.seqs[seqid]))
+
+    @property
+    def screen_key(self):
+        # Short name for the database files screened with thresholds set
+        # after collection. None if there are no such thresholds.
+        if (self.max_ambiguous is None) and (self.min_length is None):
+            return None
+        spec = "max_n={0}\nmax_ambiguous={1}\nmin_length={2}".format(
+            self.max_n, self.max_ambiguous, self.min_length)
+        return hashlib.sha1(spec.encode()).hexdigest()[:10]
+
+    def is_screened(self, seqid):
+        if (self.max_ambiguous is None) and (self.min_length is None):
+            return True
+        stats = self.load_seq_stats().get(seqid)
+        if stats is None:
+            stats = seq_stats(self.seqs[seqid])
+        return self.passes_screen(stats)
+
+    def screened_seqids(self):
+        return [
+            seqid for seqid in self.seqs.keys() if self.is_screened(seqid)]
+
+    def subset_fp(self, name):
+        base_fp, ext = os.path.splitext(self.ssu_fasta_fp)
+        if self.screen_key is not None:
+            base_fp = "{0}_screen_{1}".format(base_fp, self.screen_key)
+        if name is None:
+            return base_fp + ext
+        return "{0}_{1}{2}".format(base_fp, name, ext)
+
+    def save_subset(self, fp, seqids):
+        items = ((seqid, self.seqs[seqid]) for seqid in seqids)
+        write_indexed_fasta(items, fp, fp + ".fai")
+        # Remove any UDB built from an older version of the subset
+        udb_fp = os.path.splitext(fp)[0] + ".udb"
+        if os.path.exists(udb_fp):
+            os.remove(udb_fp)
+        return fp
+
+    def search_fasta_fp(self):
+        # Sequences that fail the screening thresholds are left out of a
+        # separate database, so the full database stays the same for runs
+        # with other thresholds. If every sequence passes, the full database
+        # is searched.
+        if self.screen_key is None:
+            return self.ssu_fasta_fp
+        fp = self.subset_fp(None)
+        with self._lock:
+            if is_fresh(fp + ".fai", self.ssu_fasta_fp):
+                return fp
+            seqids = self.screened_seqids()
+            if len(seqids) == len(self.seqs):
+                return self.ssu_fasta_fp
+            return self.save_subset(fp, seqids)
+
+    def shard_fp(self, shard, n_shards):
+        return self.subset_fp("shard{0}of{1}".format(shard + 1, n_shards))
+
+    def shard_fps(self, n_shards):
+        # Sequences are dealt out in turn, so that shards are about the same
+        # size. Each shard is indexed, and gets its own UDB when searched.
+        fps = [self.shard_fp(i, n_shards) for i in range(n_shards)]
+        with self._lock:
+            if all(is_fresh(fp + ".fai", self.ssu_fasta_fp) for fp in fps):
+                return fps
+            shard_seqids = [[] for fp in fps]
+            for i, seqid in enumerate(self.screened_seqids()):
+                shard_seqids[i % n_shards].append(seqid)
+            for fp, seqids in zip(fps, shard_seqids):
+                self.save_subset(fp, seqids)
+        return fps
+
+    @property
+    def taxonomy_nodes_fp(self):
+        return os.path.join(self.taxonomy_dir, "nodes.dmp")
+
+    def load_taxonomy(self):
+        with self._lock:
+            if self.taxonomy is not None:
+                return self.taxonomy
+            if not os.path.exists(self.taxonomy_nodes_fp):
+                os.makedirs(self.taxonomy_dir, exist_ok=True)
+                tar_fp = os.path.join(self.taxonomy_dir, "taxdump.tar.gz")
+                get_url(self.taxonomy_url, tar_fp)
+                extract_taxdump(tar_fp, self.taxonomy_dir)
+                os.remove(tar_fp)
+            self.taxonomy = Taxonomy.load(self.taxonomy_dir)
+            return self.taxonomy
+
+    def assembly_taxid(self, accession):
+        assembly = self.assemblies[accession]
+        taxid = getattr(assembly, "taxid", "")
+        if not taxid.isdigit():
+            taxid = getattr(assembly, "species_taxid", "")
+        if not taxid.isdigit():
+            return None
+        return int(taxid)
+
+    def rank_taxids(self, accession, rank):
+        # Taxon of the given rank containing an assembly, for example the
+        # order of the query
+        taxonomy = self.load_taxonomy()
+        taxid = self.assembly_taxid(accession)
+        ancestor = None
+        if taxid is not None:
+            ancestor = taxonomy.ancestor(taxid, rank)
+        if ancestor is None:
+            raise ValueError(
+                "No taxon of rank {0} for {1}".format(rank, accession))
+        return [ancestor]
+
+    def taxon_seqids(self, taxids):
+        taxonomy = self.load_taxonomy()
+        taxa = set(taxonomy.current(taxid) for taxid in taxids)
+        seqids = []
+        for accession in sorted(self.selected_accessions):
+            taxid = self.assembly_taxid(accession)
+            if (taxid is not None) and taxonomy.is_within(taxid, taxa):
+                seqids.extend(
+                    seqid for seqid in self.accession_seqids.get(accession, [])
+                    if self.is_screened(seqid))
+        return seqids
+
+    def taxon_fasta_fp(self, taxids):
+        key = hashlib.sha1(
+            ",".join(str(t) for t in sorted(taxids)).encode()).hexdigest()
+        return self.subset_fp("taxa_{0}".format(key[:10]))
+
+    def taxon_db(self, taxids):
+        # Database of 16S sequences from assemblies in the taxa. If the taxa
+        # cover every assembly, the database searched without taxa is used
+        # instead. Subset databases are saved, and get their own UDB when
+        # searched.
+        fp = self.taxon_fasta_fp(taxids)
+        index_fp = fp + ".fai"
+        with self._lock:
+            self.load_taxonomy()
+            if is_fresh(index_fp, self.ssu_fasta_fp) and \
+               is_fresh(index_fp, self.taxonomy_nodes_fp):
+                return fp
+            seqids = self.taxon_seqids(taxids)
+            if len(seqids) == len(self.screened_seqids()):
+                return self.search_fasta_fp()
+            return self.save_subset(fp, seqids)
 
     @property
     def genome_dir(self):
@@ -90,17 +363,90 @@ class RefSeq:
         genome_filename = "{0}_genomic.fna".format(assembly.basename)
         return os.path.join(self.genome_dir, genome_filename)
 
+    def has_genome(self, accession):
+        return os.path.exists(self.genome_fp(self.assemblies[accession]))
+
+    def genome_download_size(self, accession):
+        return get_url_size(self.assemblies[accession].genome_url)
+
+    def accession_lock(self, accession):
+        # Threads working on the same assembly take turns
+        with self._lock:
+            return self._accession_locks[accession]
+
     def collect_genome(self, accession):
         assembly = self.assemblies[accession]
         genome_fp = self.genome_fp(assembly)
-        if os.path.exists(genome_fp):
-            return genome_fp
-        if not os.path.exists(self.genome_dir):
-            os.makedirs(self.genome_dir)
-        get_url(assembly.genome_url, genome_fp + ".gz")
-        subprocess.check_call(["gunzip", "-q", genome_fp + ".gz"])
+        with self.accession_lock(accession):
+            if os.path.exists(genome_fp):
+                return genome_fp
+            if not os.path.exists(self.genome_dir):
+                os.makedirs(self.genome_dir, exist_ok=True)
+            get_gzip_url(assembly.genome_url, genome_fp)
+            self.link_duplicate_genome(accession)
         return genome_fp
 
+    @property
+    def fingerprint_fp(self):
+        return os.path.join(self.data_dir, "genome_fingerprints.txt")
+
+    def load_fingerprints(self):
+        with self._lock:
+            if self.fingerprints is not None:
+                return self.fingerprints
+            self.fingerprints = {}
+            if os.path.exists(self.fingerprint_fp):
+                with open(self.fingerprint_fp) as f:
+                    for accession, fingerprint in parse_accessions(f):
+                        self.fingerprints[accession] = fingerprint
+            return self.fingerprints
+
+    def genome_fingerprint(self, accession):
+        fingerprints = self.load_fingerprints()
+        with self.accession_lock(accession):
+            if accession in fingerprints:
+                return fingerprints[accession]
+            genome_fp = self.collect_genome(accession)
+            if accession in fingerprints:
+                # Computed while the genome was being collected
+                return fingerprints[accession]
+            with open(genome_fp, "rb") as f:
+                fingerprint = fingerprint_fasta(f)
+            with self._lock:
+                fingerprints[accession] = fingerprint
+                with open(self.fingerprint_fp, "a") as f:
+                    f.write("{0}\t{1}\n".format(accession, fingerprint))
+        return fingerprint
+
+    def link_duplicate_genome(self, accession):
+        # Identical genomes share one copy on disk
+        fingerprint = self.genome_fingerprint(accession)
+        genome_fp = self.genome_fp(self.assemblies[accession])
+        with self._lock:
+            fingerprints = list(self.fingerprints.items())
+        for other_accession, other_fingerprint in fingerprints:
+            if other_accession == accession:
+                continue
+            if other_fingerprint != fingerprint:
+                continue
+            other_assembly = self.assemblies.get(other_accession)
+            if other_assembly is None:
+                continue
+            other_fp = self.genome_fp(other_assembly)
+            if not os.path.exists(other_fp):
+                continue
+            if os.path.samefile(genome_fp, other_fp):
+                return other_fp
+            temp_fp = temp_name(genome_fp)
+            try:
+                os.link(other_fp, temp_fp)
+            except OSError:
+                # Hardlinks not supported here, keep the separate copy
+                return None
+            os.replace(temp_fp, genome_fp)
+            return other_fp
+        return None
+
     @property
     def rna_dir(self):
         return os.path.join(self.data_dir, "rna_fasta")
@@ -112,36 +458,166 @@ class RefSeq:
     def download_rna(self, accession):
         assembly = self.assemblies[accession]
         rna_fp = self.rna_fp(assembly)
-        if os.path.exists(rna_fp):
-            return rna_fp
-        if not os.path.exists(self.rna_dir):
-            os.makedirs(self.rna_dir)
-        get_url(assembly.rna_url, rna_fp + ".gz")
-        subprocess.check_call(["gunzip", "-q", rna_fp + ".gz"])
+        with self.accession_lock(accession):
+            if os.path.exists(rna_fp):
+                return rna_fp
+            if not os.path.exists(self.rna_dir):
+                os.makedirs(self.rna_dir, exist_ok=True)
+            get_gzip_url(assembly.rna_url, rna_fp)
         return rna_fp
 
     def get_16S_seqs(self, accession):
         rna_fp = self.download_rna(accession)
         with open(rna_fp, "rt") as f:
-            for desc, seq in parse_fasta(f):
-                if self.is_16S(desc, seq):
-                    print(desc)
-                    seqid = desc.split()[0]
-                    yield seqid, seq
-
-    def is_16S(self, desc, seq):
-        if is_full_length_16S(desc):
-            if not too_many_ambiguous_bases(seq, self.max_n):
-                return True
-        return False
+            seqs = [
+                (desc, seq) for desc, seq in parse_fasta(f)
+                if is_full_length_16S(desc)]
+        # All 16S copies from the assembly are screened as one batch
+        batch_stats = screen_seqs(seq for desc, seq in seqs)
+        for (desc, seq), stats in zip(seqs, batch_stats):
+            if self.passes_max_n(stats):
+                print(desc)
+                seqid = desc.split()[0]
+                if self.seq_stats is not None:
+                    self.seq_stats[seqid] = stats
+                yield seqid, seq
+
+    def passes_max_n(self, stats):
+        length, ambiguous_bases, max_n_run = stats
+        return (self.max_n is None) or (max_n_run <= self.max_n)
+
+    def passes_screen(self, stats):
+        length, ambiguous_bases, max_n_run = stats
+        if (self.max_n is not None) and (max_n_run > self.max_n):
+            return False
+        if (self.max_ambiguous is not None) and \
+           (ambiguous_bases > self.max_ambiguous):
+            return False
+        if (self.min_length is not None) and (length < self.min_length):
+            return False
+        return True
+
+    @property
+    def db_suffix(self):
+        if self.assembly_filter is None:
+            return ""
+        return "_" + self.assembly_filter.key
 
     @property
     def ssu_fasta_fp(self):
-        return os.path.join(self.data_dir, "refseq_16S.fasta")
+        return os.path.join(
+            self.data_dir, "refseq_16S{0}.fasta".format(self.db_suffix))
+
+    @property
+    def ssu_index_fp(self):
+        return self.ssu_fasta_fp + ".fai"
+
+    @property
+    def ssu_stats_fp(self):
+        return os.path.join(
+            self.data_dir, "refseq_16S_stats{0}.txt".format(self.db_suffix))
 
     @property
     def accession_fp(self):
-        return os.path.join(self.data_dir, "refseq_16S_accessions.txt")
+        return os.path.join(
+            self.data_dir, "refseq_16S_accessions{0}.txt".format(self.db_suffix))
+
+
+class AssemblyFilter:
+    # Conditions on columns of the assembly summary, written as
+    # "field=val1,val2" or "field!=val1,val2". An assembly is selected if it
+    # meets every condition.
+    def __init__(self, conditions):
+        self.conditions = conditions
+
+    @classmethod
+    def parse(cls, specs):
+        conditions = []
+        for spec in specs:
+            match = re.match(r"^\s*(\w+)\s*(!=|=)(.*)$", spec)
+            if match is None:
+                raise ValueError("Bad assembly filter: {0}".format(spec))
+            field, op, vals = match.groups()
+            if field not in RefseqAssembly.fields:
+                raise ValueError("Unknown assembly field: {0}".format(field))
+            vals = frozenset(v.strip() for v in vals.split(","))
+            conditions.append((field, op, vals))
+        return cls(conditions)
+
+    @property
+    def fields(self):
+        return sorted(set(field for field, op, vals in self.conditions))
+
+    @property
+    def key(self):
+        # Short name for the database files built with this filter
+        specs = sorted(
+            "{0}{1}{2}".format(field, op, ",".join(sorted(vals)))
+            for field, op, vals in self.conditions)
+        return hashlib.sha1("\n".join(specs).encode()).hexdigest()[:10]
+
+    def select(self, index, accessions):
+        selected = set(accessions)
+        for field, op, vals in self.conditions:
+            matched = set()
+            for val in vals:
+                matched.update(index[field].get(val, ()))
+            if op == "=":
+                selected.intersection_update(matched)
+            else:
+                selected.difference_update(matched)
+        return selected
+
+
+class IndexedFasta(collections.abc.Mapping):
+    # Read-only mapping from seqid to sequence, backed by a samtools-style
+    # .fai index. Sequences are read from a memory map when requested.
+    def __init__(self, fasta_fp, index_fp):
+        self.fasta_fp = fasta_fp
+        self.index = {}
+        with open(index_fp) as f:
+            for seqid, length, offset, linebases, linewidth in parse_fai(f):
+                self.index[seqid] = (length, offset, linebases, linewidth)
+        self._file = None
+        self._mmap = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        with self._lock:
+            if self._mmap is not None:
+                return
+            self._file = open(self.fasta_fp, "rb")
+            self._mmap = mmap.mmap(
+                self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+            self._mmap = None
+            self._file = None
+
+    def __getitem__(self, seqid):
+        length, offset, linebases, linewidth = self.index[seqid]
+        if length == 0:
+            return ""
+        if self._mmap is None:
+            self._open()
+        full_lines, partial_line = divmod(length, linebases)
+        span = full_lines * linewidth + partial_line
+        seq = self._mmap[offset:offset + span]
+        if length > linebases:
+            seq = seq.replace(b"\r", b"").replace(b"\n", b"")
+        return seq[:length].decode()
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, seqid):
+        return seqid in self.index
 
 
 class RefseqAssembly:
@@ -209,6 +685,90 @@ def parse_fasta(f):
     yield desc, seq.getvalue()
 
 
+def fingerprint_fasta(f):
+    # Hash of the normalized sequence, independent of headers, line
+    # wrapping, case, and record order. Expects a file opened in binary mode.
+    record_digests = []
+    record_hash = None
+    for line in f:
+        if line.startswith(b">"):
+            if record_hash is not None:
+                record_digests.append(record_hash.hexdigest())
+            record_hash = hashlib.sha1()
+        elif record_hash is not None:
+            record_hash.update(line.strip().upper())
+    if record_hash is not None:
+        record_digests.append(record_hash.hexdigest())
+    genome_hash = hashlib.sha1()
+    for digest in sorted(record_digests):
+        genome_hash.update(digest.encode("ascii"))
+    return genome_hash.hexdigest()
+
+
+def write_indexed_fasta(items, fasta_fp, index_fp):
+    # Index is closed last so that it is never older than the FASTA
+    with open(index_fp, "w") as index_f, open(fasta_fp, "wb") as f:
+        offset = 0
+        for seqid, seq in items:
+            header = ">{0}\n".format(seqid).encode()
+            seq = seq.encode()
+            f.write(header)
+            f.write(seq)
+            f.write(b"\n")
+            offset += len(header)
+            index_f.write(format_fai(seqid, len(seq), offset, len(seq)))
+            offset += len(seq) + 1
+    return fasta_fp
+
+
+def index_fasta(fasta_fp, index_fp):
+    with open(fasta_fp, "rb") as f, open(index_fp, "w") as index_f:
+        seqid = None
+        offset = 0
+        for line in f:
+            if line.startswith(b">"):
+                if seqid is not None:
+                    index_f.write(format_fai(
+                        seqid, length, seq_offset, linebases, linewidth))
+                seqid = line[1:].split()[0].decode()
+                seq_offset = offset + len(line)
+                length = 0
+                linebases = None
+                linewidth = None
+            elif seqid is not None:
+                bases = len(line.rstrip(b"\r\n"))
+                if (linebases is None) and (bases > 0):
+                    linebases = bases
+                    linewidth = len(line)
+                length += bases
+            offset += len(line)
+        if seqid is not None:
+            index_f.write(format_fai(
+                seqid, length, seq_offset, linebases, linewidth))
+    return index_fp
+
+
+def format_fai(seqid, length, offset, linebases=None, linewidth=None):
+    if linebases is None:
+        linebases = length
+    if linewidth is None:
+        linewidth = linebases + 1
+    return "{0}\t{1}\t{2}\t{3}\t{4}\n".format(
+        seqid, length, offset, linebases, linewidth)
+
+
+def parse_fai(f):
+    for line in f:
+        toks = line.rstrip("\n").split("\t")
+        yield toks[0], int(toks[1]), int(toks[2]), int(toks[3]), int(toks[4])
+
+
+def is_fresh(fp, source_fp):
+    if not os.path.exists(fp):
+        return False
+    return os.path.getmtime(fp) >= os.path.getmtime(source_fp)
+
+
 def parse_accessions(f):
     for line in f:
         if line.startswith("#"):
@@ -217,9 +777,44 @@ def parse_accessions(f):
         yield line.split("\t")
 
 
-def too_many_ambiguous_bases(seq, max_n):
-    ns = "N" * (max_n + 1)
-    return ns in seq
+SEQ_STATS_FIELDS = ["length", "ambiguous_bases", "max_n_run"]
+
+# Lookup tables for screening sequences a byte at a time. Newlines separate
+# the sequences in a batch.
+AMBIGUOUS_TABLE = bytes(
+    0 if chr(b) in "ACGTacgt" else 1 for b in range(256))
+N_RUN_TABLE = bytes(
+    b if chr(b) in "Nn\n" else ord(" ") for b in range(256))
+
+
+def screen_seqs(seqs):
+    # Length, number of ambiguous bases, and longest run of Ns for each
+    # sequence, from one translation of the whole batch per table
+    seqs = [seq.encode("ascii") for seq in seqs]
+    batch = b"\n".join(seqs)
+    ambiguous_flags = batch.translate(AMBIGUOUS_TABLE)
+    n_masks = batch.translate(N_RUN_TABLE).split(b"\n")
+    stats = []
+    start = 0
+    for seq, n_mask in zip(seqs, n_masks):
+        end = start + len(seq)
+        ambiguous_bases = ambiguous_flags.count(1, start, end)
+        max_n_run = max(map(len, n_mask.split()), default=0)
+        stats.append((len(seq), ambiguous_bases, max_n_run))
+        start = end + 1
+    return stats
+
+
+def seq_stats(seq):
+    return screen_seqs([seq])[0]
+
+
+def parse_seq_stats(f):
+    for line in f:
+        if line.startswith("seqid\t"):
+            continue
+        toks = line.rstrip("\n").split("\t")
+        yield toks[0], tuple(int(tok) for tok in toks[1:])
 
 
 def is_full_length_16S(desc):
@@ -243,6 +838,101 @@ def parse_desc(desc):
     return accession, attrs
 
 
+def get_gzip_url(url, fp):
+    # Downloaded and decompressed under a temporary name, so that a partial
+    # file is never seen at the final path
+    temp_fp = temp_name(fp)
+    get_url(url, temp_fp + ".gz")
+    default_log.run(["gunzip", "-q", temp_fp + ".gz"])
+    os.replace(temp_fp, fp)
+    return fp
+
+
+def temp_name(fp):
+    return "{0}.{1}.{2}.tmp".format(fp, os.getpid(), threading.get_ident())
+
+
+def is_complete(fp):
+    # A file cut short by an interrupted download does not end in a newline
+    if (not os.path.exists(fp)) or (os.path.getsize(fp) == 0):
+        return False
+    with open(fp, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def open_url(url, headers=None):
+    # Returns None if the server reports that the file has not changed
+    req = urllib.request.Request(url, headers={"Accept-Encoding": "gzip"})
+    for key, val in (headers or {}).items():
+        req.add_header(key, val)
+    try:
+        return urllib.request.urlopen(req)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return None
+        raise
+
+
+def response_lines(resp, url):
+    # Compressed by the server, or stored compressed
+    content_encoding = resp.headers.get("Content-Encoding")
+    if url.endswith(".gz") or (content_encoding == "gzip"):
+        resp = gzip.GzipFile(fileobj=resp)
+    return io.TextIOWrapper(resp, encoding="utf-8")
+
+
+def copy_lines(lines, f):
+    for line in lines:
+        f.write(line)
+        yield line
+
+
+VALIDATOR_HEADERS = ["ETag", "Last-Modified"]
+
+
+def load_validators(fp):
+    validators = {}
+    if os.path.exists(fp):
+        with open(fp) as f:
+            for line in f:
+                key, sep, val = line.rstrip("\n").partition("\t")
+                validators[key] = val
+    return validators
+
+
+def save_validators(fp, headers):
+    temp_fp = temp_name(fp)
+    with open(temp_fp, "w") as f:
+        for key in VALIDATOR_HEADERS:
+            val = headers.get(key)
+            if val is not None:
+                f.write("{0}\t{1}\n".format(key, val))
+    os.replace(temp_fp, fp)
+
+
+def conditional_headers(validators):
+    headers = {}
+    if "ETag" in validators:
+        headers["If-None-Match"] = validators["ETag"]
+    if "Last-Modified" in validators:
+        headers["If-Modified-Since"] = validators["Last-Modified"]
+    return headers
+
+
+def get_url_size(url):
+    # Size reported by the server, without downloading the file
+    req = urllib.request.Request(url, method="HEAD")
+    try:
+        with urllib.request.urlopen(req) as resp:
+            size = resp.headers.get("Content-Length")
+    except OSError:
+        return None
+    if size is None:
+        return None
+    return int(size)
+
+
 def get_url(url, fp):
     print("Downloading", url)
     with urllib.request.urlopen(url) as resp, open(fp, 'wb') as f:
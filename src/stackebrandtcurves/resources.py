@@ -0,0 +1,220 @@
+import collections
+import contextlib
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+class ResourceLog:
+    # Record of resources used by each external program. Records are kept
+    # in memory and, if a file is given, appended to a tab-separated log that
+    # also serves as the history for choosing thread counts.
+    fields = [
+        "tool", "threads", "input_size", "wall_time", "user_time",
+        "sys_time", "max_rss_kb", "returncode",
+    ]
+    field_types = [str, int, int, float, float, float, int, int]
+
+    def __init__(self, fp=None):
+        self.fp = None
+        self.records = []
+        self._lock = threading.Lock()
+        if fp is not None:
+            self.open(fp)
+
+    def open(self, fp):
+        self.fp = fp
+        if os.path.exists(fp):
+            with open(fp) as f:
+                self.records.extend(self.parse(f))
+
+    def add(self, record):
+        with self._lock:
+            self.records.append(record)
+            if self.fp is not None:
+                write_header = not os.path.exists(self.fp)
+                with open(self.fp, "a") as f:
+                    if write_header:
+                        f.write("\t".join(self.fields) + "\n")
+                    f.write(self.format_record(record))
+
+    @classmethod
+    def format_record(cls, record):
+        vals = ["" if record[field] is None else str(record[field])
+                for field in cls.fields]
+        return "\t".join(vals) + "\n"
+
+    @classmethod
+    def parse(cls, f):
+        for line in f:
+            if line.startswith("tool\t"):
+                continue
+            toks = line.rstrip("\n").split("\t")
+            vals = [None if tok == "" else fcn(tok)
+                    for tok, fcn in zip(toks, cls.field_types)]
+            yield dict(zip(cls.fields, vals))
+
+    def run(self, args, threads=None, input_size=None, tool=None):
+        record = run_command(
+            args, threads=threads, input_size=input_size, tool=tool)
+        self.add(record)
+        if record["returncode"] != 0:
+            raise subprocess.CalledProcessError(record["returncode"], args)
+        return record
+
+    def summary(self):
+        totals = collections.OrderedDict()
+        for record in self.records:
+            tool_totals = totals.setdefault(record["tool"], {
+                "calls": 0, "wall_time": 0.0, "cpu_time": 0.0,
+                "max_rss_kb": 0})
+            tool_totals["calls"] += 1
+            tool_totals["wall_time"] += record["wall_time"]
+            tool_totals["cpu_time"] += cpu_time(record)
+            tool_totals["max_rss_kb"] = max(
+                tool_totals["max_rss_kb"], record["max_rss_kb"] or 0)
+        return totals
+
+    def format_summary(self):
+        lines = []
+        for tool, totals in self.summary().items():
+            lines.append(
+                "{0}: {1} calls, {2:.1f} s wall, {3:.1f} s CPU, "
+                "{4} KB max RSS".format(
+                    tool, totals["calls"], totals["wall_time"],
+                    totals["cpu_time"], totals["max_rss_kb"]))
+        return lines
+
+    def cpu_rate(self, tool):
+        # CPU seconds per byte of input in earlier runs of the tool
+        total_cpu_time = 0.0
+        total_size = 0
+        for record in self.records:
+            if record["tool"] != tool:
+                continue
+            if (not record["input_size"]) or (record["user_time"] is None):
+                continue
+            total_cpu_time += cpu_time(record)
+            total_size += record["input_size"]
+        if total_size == 0:
+            return None
+        return total_cpu_time / total_size
+
+    def choose_threads(
+            self, tool, input_size, max_threads=None, min_efficiency=0.5):
+        # Use the largest number of threads that kept the CPUs busy enough
+        # in earlier runs of the same tool on inputs of similar size.
+        if max_threads is None:
+            max_threads = available_cpus()
+        efficiencies = collections.defaultdict(list)
+        for record in self.records:
+            if record["tool"] != tool:
+                continue
+            if not is_similar_size(record["input_size"], input_size):
+                continue
+            eff = parallel_efficiency(record)
+            if eff is not None:
+                efficiencies[record["threads"]].append(eff)
+        if not efficiencies:
+            return max_threads
+        good_threads = [
+            threads for threads, effs in efficiencies.items()
+            if statistics.median(effs) >= min_efficiency]
+        if good_threads:
+            threads = max(good_threads)
+            # Try more threads if they have not been tested yet
+            if max(efficiencies.keys()) == threads:
+                threads = threads * 2
+        else:
+            threads = min(efficiencies.keys()) // 2
+        return max(1, min(threads, max_threads))
+
+
+def run_command(args, threads=None, input_size=None, tool=None):
+    # Records are logged under the program name unless another tool name is
+    # given, e.g. to keep apart subcommands with different resource use
+    if tool is None:
+        tool = os.path.basename(args[0])
+    start = time.monotonic()
+    proc = subprocess.Popen(args)
+    if hasattr(os, "wait4"):
+        pid, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = exit_code(status)
+    else:
+        proc.wait()
+        rusage = None
+    wall_time = time.monotonic() - start
+    record = {
+        "tool": tool,
+        "threads": threads,
+        "input_size": input_size,
+        "wall_time": wall_time,
+        "user_time": None,
+        "sys_time": None,
+        "max_rss_kb": None,
+        "returncode": proc.returncode,
+    }
+    if rusage is not None:
+        record["user_time"] = rusage.ru_utime
+        record["sys_time"] = rusage.ru_stime
+        max_rss = rusage.ru_maxrss
+        if sys.platform == "darwin":
+            # Reported in bytes on macOS
+            max_rss = max_rss // 1024
+        record["max_rss_kb"] = max_rss
+    return record
+
+
+def exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def cpu_time(record):
+    return (record["user_time"] or 0.0) + (record["sys_time"] or 0.0)
+
+
+def parallel_efficiency(record):
+    threads = record["threads"]
+    if (not threads) or (not record["wall_time"]):
+        return None
+    if record["user_time"] is None:
+        return None
+    return cpu_time(record) / (record["wall_time"] * threads)
+
+
+def is_similar_size(size1, size2, factor=4):
+    if (size1 is None) or (size2 is None):
+        return True
+    if (size1 == 0) or (size2 == 0):
+        return size1 == size2
+    return (size1 / size2 <= factor) and (size2 / size1 <= factor)
+
+
+def available_cpus():
+    # https://docs.python.org/3/library/multiprocessing.html#multiprocessing.cpu_count
+    return len(os.sched_getaffinity(0))
+
+
+@contextlib.contextmanager
+def workspace(parent_dir):
+    # Private directory for the files of one call, so that concurrent calls
+    # sharing a work directory do not overwrite each other's files
+    work_dir = tempfile.mkdtemp(dir=parent_dir)
+    try:
+        yield work_dir
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def file_size(*fps):
+    return sum(os.path.getsize(fp) for fp in fps if os.path.exists(fp))
+
+
+default_log = ResourceLog()
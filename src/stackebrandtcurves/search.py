@@ -1,12 +1,31 @@
+import array
 import collections
+import collections.abc
+import concurrent.futures
+import gzip
+import hashlib
+import math
 import os
 import random
-import subprocess
+import re
 import tempfile
+import threading
+
+from .refseq import IndexedFasta
+from .resources import (
+    ResourceLog, default_log, available_cpus, file_size, workspace,
+)
 
 
 class Vsearch:
-    def __init__(self, work_dir=None):
+    def __init__(self, work_dir=None, resource_log=None, cache_dir=None):
+        if resource_log is None:
+            resource_log = default_log
+        self.resource_log = resource_log
+        if cache_dir is not None:
+            self.cache = SearchCache(cache_dir)
+        else:
+            self.cache = None
         if work_dir is not None:
             if not os.path.exists(work_dir):
                 os.makedirs(work_dir)
@@ -15,46 +34,387 @@ class Vsearch:
             self._work_dir_obj = tempfile.TemporaryDirectory()
             self.work_dir = self._work_dir_obj.name
 
-    @property
-    def filtered_fp(self):
-        return self.get_temp_fp("filtered_subject.fasta")
-
-    def get_temp_fp(self, filename):
-        return os.path.join(self.work_dir, filename)
+    def workspace(self):
+        return workspace(self.work_dir)
 
     def search_once(
             self, query_seqid, query_seq, subject_fp, min_pctid=90.0,
             max_hits=100000, threads=None, clear_db=False):
-        query_fp = self.get_temp_fp("query.fasta")
-        with open(query_fp, "w") as f:
-            f.write(">{0}\n{1}\n".format(query_seqid, query_seq))
-        hits_fp = self.get_temp_fp("hits.txt")
-
-        aligner = PctidAligner(subject_fp)
-        aligner.search(
-            query_fp, hits_fp, min_pctid=min_pctid, max_hits=max_hits,
-            threads=threads)
-        if clear_db:
-            aligner.clear_db()
-
-        with open(hits_fp) as f:
-            for hit in aligner.parse(f):
-                # Lowercase letters in the hit mess up our counting
-                hit['qseq'] = hit['qseq'].upper()
-                hit['sseq'] = hit['sseq'].upper()
-                hit["vsearch_pident"] = hit["pident"]
-                nt_positions = len(hit["qseq"])
-                nt_matches = count_matches(hit["qseq"], hit["sseq"])
-                hit["pident"] = 100 * (nt_matches / nt_positions)
-                yield hit
+        return self.search_many(
+            [(query_seqid, query_seq)], subject_fp, min_pctid=min_pctid,
+            max_hits=max_hits, threads=threads, clear_db=clear_db)
+
+    def search_many(
+            self, query_seqs, subject_fp, min_pctid=90.0,
+            max_hits=100000, threads=None, clear_db=False, subject_seqs=None):
+        # Temporary databases are not worth caching
+        use_cache = (self.cache is not None) and not clear_db
+        if use_cache:
+            cache_key = self.cache.key(query_seqs, subject_fp)
+            hits = self.cache.get(cache_key, min_pctid, max_hits)
+            if hits is not None:
+                return hits
+
+        hits, query_rows = self.search_uncached(
+            query_seqs, subject_fp, min_pctid=min_pctid, max_hits=max_hits,
+            threads=threads, clear_db=clear_db, subject_seqs=subject_seqs)
+
+        if use_cache:
+            self.cache.put(cache_key, min_pctid, max_hits, hits, query_rows)
+        return hits
+
+    def search_uncached(
+            self, query_seqs, subject_fp, min_pctid=90.0,
+            max_hits=100000, threads=None, clear_db=False, subject_seqs=None):
+        # Returns the hits, and the number of rows reported by vsearch for
+        # each query, before self-hits are removed
+        query_rows = collections.Counter()
+
+        # If the subject sequences are given, vsearch reports only a compact
+        # alignment, which is scored against the sequences in memory
+        compact = subject_seqs is not None
+        with self.workspace() as work_dir:
+            # All query sequences are searched in one run of vsearch
+            query_fp = os.path.join(work_dir, "query.fasta")
+            with open(query_fp, "w") as f:
+                for query_seqid, query_seq in query_seqs:
+                    f.write(">{0}\n{1}\n".format(query_seqid, query_seq))
+            hits_fp = os.path.join(work_dir, "hits.txt")
+
+            aligner = PctidAligner(subject_fp, self.resource_log, compact)
+            aligner.search(
+                query_fp, hits_fp, min_pctid=min_pctid, max_hits=max_hits,
+                threads=threads)
+            if clear_db:
+                aligner.clear_db()
+
+            # Alignments are dropped as soon as each hit is scored
+            with open(hits_fp) as f:
+                parsed_hits = aligner.parse(f, query_rows)
+                if compact:
+                    seqs = collections.ChainMap(dict(query_seqs), subject_seqs)
+                    hits = HitTable.from_hits(
+                        score_compact_hits(parsed_hits, seqs))
+                else:
+                    hits = HitTable.from_hits(score_hits(parsed_hits))
+        return hits, query_rows
+
+    def search_sharded(
+            self, query_seqs, subject_fp, shard_fps, min_pctid=90.0,
+            max_hits=100000, threads=None, compact=False, executor=None,
+            max_workers=None):
+        # Each shard of the subject database is searched in a separate
+        # process, then the hits are merged. Any executor from
+        # concurrent.futures can be given to run the shard searches.
+        if self.cache is not None:
+            cache_key = self.cache.key(query_seqs, subject_fp)
+            hits = self.cache.get(cache_key, min_pctid, max_hits)
+            if hits is not None:
+                return hits
+
+        if threads is None:
+            threads = available_cpus()
+        if max_workers is None:
+            max_workers = len(shard_fps)
+        # Threads are shared among the shards searched at the same time
+        shard_threads = max(1, threads // min(max_workers, len(shard_fps)))
+        own_executor = executor is None
+        if own_executor:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers)
+        try:
+            futures = [
+                executor.submit(
+                    search_shard, self.work_dir, query_seqs, shard_fp,
+                    min_pctid, max_hits, shard_threads, compact)
+                for shard_fp in shard_fps]
+            results = [future.result() for future in futures]
+        finally:
+            if own_executor:
+                executor.shutdown()
+
+        shard_hits = []
+        query_rows = collections.Counter()
+        for hits, shard_query_rows, records in results:
+            shard_hits.append(hits)
+            query_rows.update(shard_query_rows)
+            for record in records:
+                self.resource_log.add(record)
+        hits = merge_hits(shard_hits, max_hits)
+
+        if self.cache is not None:
+            self.cache.put(cache_key, min_pctid, max_hits, hits, query_rows)
+        return hits
+
+
+def search_shard(
+        work_dir, query_seqs, shard_fp, min_pctid, max_hits, threads,
+        compact):
+    # Runs in a worker process. Resource records are sent back to the
+    # parent process with the hits.
+    resource_log = ResourceLog()
+    app = Vsearch(work_dir, resource_log)
+    subject_seqs = None
+    if compact:
+        subject_seqs = IndexedFasta(shard_fp, shard_fp + ".fai")
+    hits, query_rows = app.search_uncached(
+        query_seqs, shard_fp, min_pctid=min_pctid, max_hits=max_hits,
+        threads=threads, subject_seqs=subject_seqs)
+    if subject_seqs is not None:
+        subject_seqs.close()
+    return hits, query_rows, resource_log.records
+
+
+def merge_hits(tables, max_hits):
+    # Keeps the hits with highest percent ID for each query, up to max_hits
+    merged = HitTable()
+    for table in tables:
+        merged.extend(table)
+    by_query = collections.defaultdict(list)
+    for idx, qidx in enumerate(merged.qidxs):
+        by_query[qidx].append(idx)
+    idxs = []
+    for query_idxs in by_query.values():
+        query_idxs.sort(key=lambda idx: merged.pidents[idx], reverse=True)
+        idxs.extend(query_idxs[:max_hits])
+    return merged.subset(idxs)
+
+
+class HitTable:
+    # Scored hits stored column by column. Sequence IDs are stored once, and
+    # hits refer to them by index. Indexing or iterating over the table gives
+    # light-weight views of single hits.
+    fields = ["qseqid", "sseqid", "vsearch_pident", "pident"]
+
+    def __init__(self, seqids=None, seqid_idxs=None):
+        if seqids is None:
+            seqids = []
+            seqid_idxs = {}
+        self.seqids = seqids
+        self.seqid_idxs = seqid_idxs
+        self.qidxs = array.array("I")
+        self.sidxs = array.array("I")
+        self.vsearch_pidents = array.array("d")
+        self.pidents = array.array("d")
+
+    @classmethod
+    def from_hits(cls, hits):
+        if isinstance(hits, cls):
+            return hits
+        table = cls()
+        for hit in hits:
+            table.append(
+                hit["qseqid"], hit["sseqid"],
+                hit.get("vsearch_pident", hit["pident"]), hit["pident"])
+        return table
+
+    def seqid_idx(self, seqid):
+        idx = self.seqid_idxs.get(seqid)
+        if idx is None:
+            idx = len(self.seqids)
+            self.seqids.append(seqid)
+            self.seqid_idxs[seqid] = idx
+        return idx
+
+    def append(self, qseqid, sseqid, vsearch_pident, pident):
+        self.qidxs.append(self.seqid_idx(qseqid))
+        self.sidxs.append(self.seqid_idx(sseqid))
+        self.vsearch_pidents.append(vsearch_pident)
+        self.pidents.append(pident)
+
+    def extend(self, other):
+        for i in range(len(other)):
+            self.append(
+                other.qseqid(i), other.sseqid(i), other.vsearch_pidents[i],
+                other.pidents[i])
+
+    def subset(self, idxs):
+        table = HitTable(self.seqids, self.seqid_idxs)
+        for i in idxs:
+            table.qidxs.append(self.qidxs[i])
+            table.sidxs.append(self.sidxs[i])
+            table.vsearch_pidents.append(self.vsearch_pidents[i])
+            table.pidents.append(self.pidents[i])
+        return table
+
+    def qseqid(self, i):
+        return self.seqids[self.qidxs[i]]
+
+    def sseqid(self, i):
+        return self.seqids[self.sidxs[i]]
+
+    def column(self, field):
+        if field == "qseqid":
+            return [self.seqids[i] for i in self.qidxs]
+        if field == "sseqid":
+            return [self.seqids[i] for i in self.sidxs]
+        if field == "vsearch_pident":
+            return self.vsearch_pidents
+        if field == "pident":
+            return self.pidents
+        raise KeyError(field)
+
+    def get_value(self, i, field):
+        if field == "qseqid":
+            return self.qseqid(i)
+        if field == "sseqid":
+            return self.sseqid(i)
+        if field == "vsearch_pident":
+            return self.vsearch_pidents[i]
+        if field == "pident":
+            return self.pidents[i]
+        raise KeyError(field)
+
+    def __len__(self):
+        return len(self.pidents)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return HitRow(self, i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield HitRow(self, i)
+
+
+class HitRow(collections.abc.Mapping):
+    __slots__ = ["table", "idx"]
+
+    def __init__(self, table, idx):
+        self.table = table
+        self.idx = idx
+
+    def __getitem__(self, field):
+        return self.table.get_value(self.idx, field)
+
+    def __iter__(self):
+        return iter(HitTable.fields)
+
+    def __len__(self):
+        return len(HitTable.fields)
+
+    def __repr__(self):
+        return "HitRow({0!r})".format(dict(self))
+
+
+class SearchCache:
+    # Scored hits saved on disk, keyed by the query sequences and the subject
+    # database. The minimum percent ID and maximum number of hits are saved
+    # with the hits, so that a search with a higher minimum or fewer hits can
+    # be answered from the cache. Alignments are not saved. The number of
+    # rows that vsearch reported for each query, including any self-hit, is
+    # saved to tell if the search for that query was cut short.
+    fields = HitTable.fields
+    field_types = [str, str, float, float]
+    version = "2"
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def key(self, query_seqs, subject_fp):
+        h = hashlib.sha1()
+        h.update("version {0}\n".format(self.version).encode())
+        for query_seqid, query_seq in query_seqs:
+            h.update("{0}\n{1}\n".format(query_seqid, query_seq).encode())
+        st = os.stat(subject_fp)
+        h.update("{0}\t{1}\t{2}\n".format(
+            os.path.abspath(subject_fp), st.st_size, st.st_mtime_ns).encode())
+        return h.hexdigest()
+
+    def entry_fp(self, key):
+        return os.path.join(self.cache_dir, key + ".tsv.gz")
+
+    def get(self, key, min_pctid, max_hits):
+        fp = self.entry_fp(key)
+        if not os.path.exists(fp):
+            return None
+        with gzip.open(fp, "rt") as f:
+            cached_min_pctid, cached_max_hits, query_rows, hits = self.parse(f)
+        if min_pctid < cached_min_pctid:
+            return None
+        if max_hits > cached_max_hits:
+            return None
+        # vsearch stops at max_hits for each query, so if the cached search
+        # for a query was cut short, hits that would pass a higher minimum
+        # may be missing. With the same minimum, the first hits of a search
+        # that was cut short are the hits of a search with fewer hits.
+        raised_min = min_pctid > cached_min_pctid
+        query_idxs = collections.defaultdict(list)
+        for i, pident in enumerate(hits.vsearch_pidents):
+            if pident >= min_pctid:
+                query_idxs[hits.qseqid(i)].append(i)
+        for qseqid, rows in query_rows.items():
+            was_truncated = rows >= cached_max_hits
+            if raised_min and was_truncated and \
+               (len(query_idxs[qseqid]) < max_hits):
+                return None
+        idxs = []
+        for qseqid_idxs in query_idxs.values():
+            idxs.extend(qseqid_idxs[:max_hits])
+        idxs.sort()
+        return hits.subset(idxs)
+
+    def put(self, key, min_pctid, max_hits, hits, query_rows):
+        hits = HitTable.from_hits(hits)
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+        fp = self.entry_fp(key)
+        fd, temp_fp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        os.close(fd)
+        with gzip.open(temp_fp, "wt") as f:
+            f.write("# min_pctid\t{0}\n".format(min_pctid))
+            f.write("# max_hits\t{0}\n".format(max_hits))
+            for qseqid, rows in query_rows.items():
+                f.write("# query_rows\t{0}\t{1}\n".format(qseqid, rows))
+            for i in range(len(hits)):
+                vals = [hits.get_value(i, field) for field in self.fields]
+                f.write("\t".join(str(val) for val in vals))
+                f.write("\n")
+        os.replace(temp_fp, fp)
+
+    @classmethod
+    def parse(cls, f):
+        min_pctid = None
+        max_hits = None
+        query_rows = {}
+        hits = HitTable()
+        for line in f:
+            toks = line.rstrip("\n").split("\t")
+            if toks[0] == "# min_pctid":
+                min_pctid = float(toks[1])
+            elif toks[0] == "# max_hits":
+                max_hits = int(toks[1])
+            elif toks[0] == "# query_rows":
+                query_rows[toks[1]] = int(toks[2])
+            else:
+                vals = [fcn(tok) for tok, fcn in zip(toks, cls.field_types)]
+                hits.append(*vals)
+        return min_pctid, max_hits, query_rows, hits
+
+
+# Threads building the same UDB wait for the first one to finish
+udb_lock = threading.Lock()
 
 
 class PctidAligner:
     field_names = ["qseqid", "sseqid", "pident", "qseq", "sseq"]
+    userfields = "query+target+id2+qrow+trow"
+    compact_field_names = [
+        "qseqid", "sseqid", "pident", "caln", "qlo", "qhi", "tlo", "thi"]
+    compact_userfields = "query+target+id2+caln+qlo+qhi+tlo+thi"
     hits_fp = "refseq_16S_hits.txt"
 
-    def __init__(self, fasta_fp):
+    def __init__(self, fasta_fp, resource_log=None, compact=False):
         self.fasta_fp = fasta_fp
+        if resource_log is None:
+            resource_log = default_log
+        self.resource_log = resource_log
+        self.compact = compact
+        if compact:
+            self.field_names = self.compact_field_names
+            self.userfields = self.compact_userfields
 
     @property
     def reference_udb_fp(self):
@@ -62,15 +422,25 @@ class PctidAligner:
         return base_fp + ".udb"
 
     def make_reference_udb(self):
-        if os.path.exists(self.reference_udb_fp):
-            return None
-        args = [
-            "vsearch",
-            "--makeudb_usearch", self.fasta_fp,
-            "--output", self.reference_udb_fp,
-            "--dbmask", "none",
-        ]
-        return subprocess.check_call(args)
+        with udb_lock:
+            if os.path.exists(self.reference_udb_fp):
+                return None
+            # Written under a temporary name, so that other processes never
+            # see a partial database
+            temp_fp = "{0}.{1}.tmp".format(self.reference_udb_fp, os.getpid())
+            args = [
+                "vsearch",
+                "--makeudb_usearch", self.fasta_fp,
+                "--output", temp_fp,
+                "--dbmask", "none",
+            ]
+            # Kept apart from searches in the log, so that single-threaded
+            # database builds do not count towards choosing search threads
+            record = self.resource_log.run(
+                args, threads=1, input_size=file_size(self.fasta_fp),
+                tool="vsearch-makeudb")
+            os.replace(temp_fp, self.reference_udb_fp)
+            return record
 
     def clear_db(self):
         os.remove(self.reference_udb_fp)
@@ -90,35 +460,222 @@ class PctidAligner:
             "--db", self.reference_udb_fp,
             "--userout", hits_fp,
             "--iddef", "2", "--id", min_id,
-            "--userfields",
-            "query+target+id2+qrow+trow",
+            "--userfields", self.userfields,
             "--maxaccepts", str(max_hits),
         ]
         if threads is not None:
             args.extend(["--threads", str(threads)])
-        subprocess.check_call(args)
+        else:
+            threads = available_cpus()
+        self.resource_log.run(
+            args, threads=threads,
+            input_size=file_size(input_fp, self.fasta_fp))
         return hits_fp
 
-    def parse(self, f):
+    def parse(self, f, query_rows=None):
+        # Rows for each query are counted before self-hits are removed
         for line in f:
             line = line.strip()
             if line.startswith("#"):
                 continue
             vals = line.split("\t")
             hit = dict(zip(self.field_names, vals))
+            if query_rows is not None:
+                query_rows[hit["qseqid"]] += 1
             if hit["qseqid"] != hit["sseqid"]:
                 yield hit
 
 
+def score_hits(hits):
+    for hit in hits:
+        # Lowercase letters in the hit mess up our counting
+        hit['qseq'] = hit['qseq'].upper()
+        hit['sseq'] = hit['sseq'].upper()
+        hit["vsearch_pident"] = float(hit["pident"])
+        nt_positions = len(hit["qseq"])
+        nt_matches = count_matches(hit["qseq"], hit["sseq"])
+        hit["pident"] = 100 * (nt_matches / nt_positions)
+        yield hit
+
+
+def score_compact_hits(hits, seqs):
+    for hit in hits:
+        qseq = seqs[hit["qseqid"]].upper()
+        sseq = seqs[hit["sseqid"]].upper()
+        hit["vsearch_pident"] = float(hit["pident"])
+        nt_positions, nt_matches = score_caln(
+            hit["caln"], qseq, sseq, int(hit["qlo"]), int(hit["qhi"]),
+            int(hit["tlo"]), int(hit["thi"]))
+        hit["pident"] = 100 * (nt_matches / nt_positions)
+        yield hit
+
+
+def score_caln(caln, qseq, sseq, qlo, qhi, tlo, thi):
+    # Count alignment columns and matching columns from a CIGAR string and
+    # the aligned sequences, giving the same result as count_matches on the
+    # rows of the alignment. Coordinates are 1-based, as reported by vsearch.
+    if caln == "=":
+        ops = [(qhi - qlo + 1, "M")]
+    else:
+        ops = [(int(n) if n else 1, op)
+               for n, op in re.findall(r"(\d*)([MID])", caln)]
+    # Terminal gaps are not part of the aligned segment
+    while ops and ops[0][1] != "M":
+        ops.pop(0)
+    while ops and ops[-1][1] != "M":
+        ops.pop()
+
+    qpos = qlo - 1
+    spos = tlo - 1
+    nt_positions = 0
+    nt_matches = 0
+    for n, op in ops:
+        nt_positions += n
+        if op == "M":
+            nt_matches += count_matches(
+                qseq[qpos:qpos + n], sseq[spos:spos + n])
+            qpos += n
+            spos += n
+        elif op == "D":
+            # In vsearch alignments, D uses up query positions and I uses up
+            # subject positions. Only N matches a gap.
+            nt_matches += qseq.count("N", qpos, qpos + n)
+            qpos += n
+        else:
+            nt_matches += sseq.count("N", spos, spos + n)
+            spos += n
+    return nt_positions, nt_matches
+
+
+def aggregate_hits(hits, subject_key, method="max"):
+    # One hit per subject, from hits of several query sequences. The hit with
+    # the highest percent ID represents the subject, and its percent ID is
+    # replaced by the aggregate value:
+    #   max: highest percent ID over all pairs of 16S copies
+    #   mean: average percent ID over all pairs of 16S copies
+    #   best-copy: average over query copies of the best percent ID for each
+    if method not in AGGREGATION_METHODS:
+        raise ValueError("Unknown aggregation method: {0}".format(method))
+    hits = HitTable.from_hits(hits)
+    best_idxs = {}
+    totals = collections.defaultdict(float)
+    counts = collections.defaultdict(int)
+    best_by_copy = collections.defaultdict(dict)
+    for idx in range(len(hits)):
+        subject = subject_key(hits.sseqid(idx))
+        pident = hits.pidents[idx]
+        best_idx = best_idxs.get(subject)
+        if (best_idx is None) or (pident > hits.pidents[best_idx]):
+            best_idxs[subject] = idx
+        totals[subject] += pident
+        counts[subject] += 1
+        copy_pidents = best_by_copy[subject]
+        qidx = hits.qidxs[idx]
+        if pident > copy_pidents.get(qidx, -1.0):
+            copy_pidents[qidx] = pident
+
+    subjects = list(best_idxs.keys())
+    aggregated = hits.subset([best_idxs[s] for s in subjects])
+    for idx, subject in enumerate(subjects):
+        if method == "mean":
+            aggregated.pidents[idx] = totals[subject] / counts[subject]
+        elif method == "best-copy":
+            copy_pidents = best_by_copy[subject].values()
+            aggregated.pidents[idx] = sum(copy_pidents) / len(copy_pidents)
+    return aggregated
+
+
+AGGREGATION_METHODS = ["max", "mean", "best-copy"]
+
+
 def limit_hits(hits, nmax):
+    if not isinstance(hits, HitTable):
+        hits = list(hits)
     by_pctid = collections.defaultdict(list)
-    for hit in hits:
-        by_pctid[hit["pident"]].append(hit)
-    for pctid, pctid_hits in by_pctid.items():
-        if len(pctid_hits) > nmax:
-            pctid_hits = random.sample(pctid_hits, k=nmax)
-        for hit in pctid_hits:
-            yield hit
+    for idx, pident in enumerate(hit_column(hits, "pident")):
+        by_pctid[pident].append(idx)
+    idxs = []
+    for pctid, pctid_idxs in by_pctid.items():
+        if len(pctid_idxs) > nmax:
+            pctid_idxs = random.sample(pctid_idxs, k=nmax)
+        idxs.extend(pctid_idxs)
+    return select_hits(hits, idxs)
+
+
+def sample_hits(
+        hits, subject_key, bin_width=0.1, max_per_bin=100, max_subjects=None,
+        max_downloads=None, is_cached=None, rng=None):
+    # Hits are binned by percent ID, and bins take turns selecting hits so
+    # that the budget for subjects and downloads is spread across the curve.
+    # Within a bin, hits to subjects that are already cached come first.
+    if rng is None:
+        rng = random
+    if not isinstance(hits, HitTable):
+        hits = list(hits)
+    hit_subjects = [subject_key(s) for s in hit_column(hits, "sseqid")]
+    by_bin = collections.defaultdict(list)
+    for idx, pident in enumerate(hit_column(hits, "pident")):
+        by_bin[pctid_bin(pident, bin_width)].append(idx)
+
+    queues = []
+    for bin_key in sorted(by_bin.keys(), reverse=True):
+        bin_idxs = by_bin[bin_key]
+        rng.shuffle(bin_idxs)
+        if is_cached is not None:
+            bin_idxs.sort(key=lambda i: not is_cached(hit_subjects[i]))
+        queues.append(collections.deque(bin_idxs))
+    bin_counts = [0] * len(queues)
+
+    selected = set()
+    subjects = set()
+    n_downloads = 0
+    active = list(range(len(queues)))
+    while active:
+        still_active = []
+        for bin_idx in active:
+            queue = queues[bin_idx]
+            while queue:
+                idx = queue.popleft()
+                subject = hit_subjects[idx]
+                if subject not in subjects:
+                    if (max_subjects is not None) and \
+                       (len(subjects) >= max_subjects):
+                        continue
+                    needs_download = (
+                        (is_cached is not None) and not is_cached(subject))
+                    if needs_download and (max_downloads is not None) and \
+                       (n_downloads >= max_downloads):
+                        continue
+                    subjects.add(subject)
+                    if needs_download:
+                        n_downloads += 1
+                selected.add(idx)
+                bin_counts[bin_idx] += 1
+                break
+            if queue and (bin_counts[bin_idx] < max_per_bin):
+                still_active.append(bin_idx)
+        active = still_active
+
+    return select_hits(hits, sorted(selected))
+
+
+def hit_column(hits, field):
+    if isinstance(hits, HitTable):
+        return hits.column(field)
+    return [hit[field] for hit in hits]
+
+
+def select_hits(hits, idxs):
+    if isinstance(hits, HitTable):
+        return hits.subset(idxs)
+    return [hits[idx] for idx in idxs]
+
+
+def pctid_bin(pctid, bin_width):
+    if bin_width is None:
+        return pctid
+    # Small tolerance so that values like 99.7 stay in their own bin
+    return math.floor(pctid / bin_width + 1e-9)
 
 
 AMBIGUOUS_BASES = {
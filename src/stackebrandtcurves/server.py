@@ -0,0 +1,154 @@
+import argparse
+import copy
+import http.server
+import json
+import random
+import urllib.request
+
+from .refseq import RefSeq
+from .application import StackebrandtApp, AppResult
+from .resources import default_log
+from .command import (
+    add_query_arguments, add_database_arguments, configure_app,
+    query_options, default_output_file, search_cache_dir,
+)
+
+DEFAULT_URL = "http://127.0.0.1:8642"
+
+class QueryServer(http.server.ThreadingHTTPServer):
+    # Keeps the database loaded between queries. Each query gets a copy of
+    # the base app, so options from one query do not leak into the next,
+    # while the database, search, and ANI workspaces are shared. Queries
+    # run in separate threads.
+    def __init__(self, server_address, app):
+        super().__init__(server_address, QueryHandler)
+        self.app = app
+
+    def query(self, request):
+        app = copy.copy(self.app)
+        configure_app(app, request.get("options", {}))
+        rng = random.Random(request.get("seed", 42))
+        return app.run(request["accession"], rng)
+
+
+class QueryHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/status":
+            self.send_error(404)
+            return
+        db = self.server.app.db
+        self.send_json_header()
+        self.write_json({
+            "assemblies": len(db.assemblies),
+            "seqs": len(db.seqs),
+        })
+
+    def do_POST(self):
+        if self.path != "/query":
+            self.send_error(404)
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            request = json.loads(self.rfile.read(length))
+            results = self.server.query(request)
+        except (ValueError, KeyError) as e:
+            self.send_error(400, str(e))
+            return
+        # Rows are streamed back as JSON lines while the query runs
+        self.send_json_header()
+        n_results = 0
+        try:
+            for result in results:
+                self.write_json({"result": result.as_dict()})
+                n_results += 1
+        except Exception as e:
+            self.write_json({"error": "{0}: {1}".format(type(e).__name__, e)})
+            return
+        self.write_json({"done": n_results})
+
+    def send_json_header(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+
+    def write_json(self, obj):
+        self.wfile.write(json.dumps(obj).encode())
+        self.wfile.write(b"\n")
+        self.wfile.flush()
+
+
+def query_server(url, accession, options=None, seed=42):
+    request = {"accession": accession, "options": options or {}, "seed": seed}
+    req = urllib.request.Request(
+        url.rstrip("/") + "/query", data=json.dumps(request).encode(),
+        headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req) as resp:
+        for line in resp:
+            msg = json.loads(line)
+            if "result" in msg:
+                yield msg["result"]
+            elif "error" in msg:
+                raise RuntimeError(msg["error"])
+
+
+def main_server(argv=None):
+    p = argparse.ArgumentParser()
+    p.add_argument(
+        "--host", default="127.0.0.1",
+        help="Address for the server (default: %(default)s)",
+    )
+    p.add_argument(
+        "--port", type=int, default=8642,
+        help="Port for the server (default: %(default)s)",
+    )
+    add_database_arguments(p)
+    args = p.parse_args(argv)
+
+    if args.resource_log is not None:
+        default_log.open(args.resource_log)
+    db = RefSeq(
+        args.data_dir, args.max_n, args.assembly_filter, args.taxonomy_dir,
+        args.max_ambiguous, args.min_length)
+    db.load(args.refresh_summary)
+    app = StackebrandtApp(
+        db, args.search_dir, args.ani_dir,
+        search_cache_dir=search_cache_dir(args))
+
+    server = QueryServer((args.host, args.port), app)
+    print("Serving on {0}:{1}".format(args.host, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main_client(argv=None):
+    p = argparse.ArgumentParser()
+    p.add_argument(
+        "assembly_accession",
+        help="Accession of type strain assembly",
+    )
+    p.add_argument(
+        "--output-file",
+        help="Output file (default: created from assembly accession)",
+    )
+    p.add_argument(
+        "--server-url", default=DEFAULT_URL,
+        help="URL of the query server (default: %(default)s)",
+    )
+    add_query_arguments(p)
+    args = p.parse_args(argv)
+
+    if args.output_file is None:
+        args.output_file = default_output_file(args.assembly_accession)
+
+    results = query_server(
+        args.server_url, args.assembly_accession, query_options(args),
+        args.seed)
+
+    with open(args.output_file, "w") as f:
+        f.write(AppResult.output_header)
+        for result in results:
+            f.write(AppResult.format_dict(result))
@@ -0,0 +1,76 @@
+import os
+import shutil
+import sys
+import tarfile
+
+
+class Taxonomy:
+    # Tree of NCBI taxa, read from nodes.dmp and merged.dmp in the taxonomy
+    # dump. Taxon IDs are kept as integers to save memory.
+    def __init__(self):
+        self.parents = {}
+        self.ranks = {}
+        self.merged = {}
+
+    @classmethod
+    def load(cls, taxonomy_dir):
+        taxonomy = cls()
+        with open(os.path.join(taxonomy_dir, "nodes.dmp")) as f:
+            for toks in parse_dmp(f):
+                taxonomy.add(int(toks[0]), int(toks[1]), toks[2])
+        merged_fp = os.path.join(taxonomy_dir, "merged.dmp")
+        if os.path.exists(merged_fp):
+            with open(merged_fp) as f:
+                for toks in parse_dmp(f):
+                    taxonomy.merged[int(toks[0])] = int(toks[1])
+        return taxonomy
+
+    def add(self, taxid, parent, rank):
+        self.parents[taxid] = parent
+        self.ranks[taxid] = sys.intern(rank)
+
+    def current(self, taxid):
+        taxid = int(taxid)
+        return self.merged.get(taxid, taxid)
+
+    def lineage(self, taxid):
+        taxid = self.current(taxid)
+        lineage = []
+        while taxid in self.parents:
+            lineage.append(taxid)
+            parent = self.parents[taxid]
+            if parent == taxid:
+                break
+            taxid = parent
+        return lineage
+
+    def ancestor(self, taxid, rank):
+        for ancestor in self.lineage(taxid):
+            if self.ranks[ancestor] == rank:
+                return ancestor
+        return None
+
+    def is_within(self, taxid, taxa):
+        return any(ancestor in taxa for ancestor in self.lineage(taxid))
+
+
+def parse_dmp(f):
+    for line in f:
+        line = line.rstrip("\n")
+        if line.endswith("\t|"):
+            line = line[:-2]
+        yield line.split("\t|\t")
+
+
+def extract_taxdump(tar_fp, taxonomy_dir):
+    # nodes.dmp is written last, so that its presence means the dump is
+    # complete
+    with tarfile.open(tar_fp) as tar:
+        for filename in ["merged.dmp", "nodes.dmp"]:
+            member = tar.getmember(filename)
+            with tar.extractfile(member) as src:
+                fp = os.path.join(taxonomy_dir, filename)
+                temp_fp = fp + ".tmp"
+                with open(temp_fp, "wb") as dest:
+                    shutil.copyfileobj(src, dest)
+                os.replace(temp_fp, fp)
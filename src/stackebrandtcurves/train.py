@@ -0,0 +1,147 @@
+import argparse
+import os
+import random
+
+from .application import StackebrandtApp, AppResult
+from .pairs import PairTable
+from .refseq import RefSeq
+from .search import PctidAligner, score_compact_hits
+
+def main_train_soft_threshold(argv=None):
+    p = argparse.ArgumentParser()
+    p.add_argument(
+        "--output-file", type=argparse.FileType("w"),
+        default="refseq_pctid_ani.tsv",
+        help="Output file",
+    )
+    p.add_argument(
+        "--min_pctid", type=float, default=97.0,
+        help="Minimum 16S percent ID",
+    )
+    p.add_argument(
+        "--max-n", type=int, default=5,
+        help="Maximum number of Ns in 16S sequences (default: %(default)s)",
+    )
+    p.add_argument(
+        "--max-hits", type=int, default=10000,
+        help=(
+            "Maximum number of hits for each sequence in the all-vs-all "
+            "search (default: %(default)s)"),
+    )
+    p.add_argument(
+        "--pctid-bin-width", type=float, default=0.1,
+        help="Width of 16S percent ID bins (default: %(default)s)",
+    )
+    p.add_argument(
+        "--num-threads", type=int,
+        help="Number of threads for 16S percent ID (default: use all CPUs)",
+    )
+    p.add_argument(
+        "--num-ani", type=int, default=100,
+        help="Number of genome pairs on which to evaluate ANI",
+    )
+    p.add_argument(
+        "--max-tries", type=int, default=10,
+        help="Number of genome pairs to try for each 16S percent ID",
+    )
+    p.add_argument(
+        "--seed", type=int, default=42,
+        help="Random number seed",
+    )
+    p.add_argument(
+        "--ani-dir",
+        help="Directory for ANI-related files (default: temp directory)",
+    )
+    p.add_argument(
+        "--data-dir", default="refseq_data",
+        help="Data directory (default: refseq_data)",
+    )
+    args = p.parse_args(argv)
+    args.output_file.write(AppResult.output_header)
+
+    # Set seed for 16S selection
+    random.seed(args.seed)
+
+    db = RefSeq(args.data_dir, args.max_n)
+    db.load()
+
+    # All-vs-all search with one random sequence from each assembly, done
+    # once and saved as a table of pairs
+    pairs_prefix, _ = os.path.splitext(db.subset_fp("pairs"))
+    pairs_params = {
+        "min_pctid": args.min_pctid,
+        "max_hits": args.max_hits,
+        "max_n": args.max_n,
+        "seed": args.seed,
+    }
+    pairs = PairTable(pairs_prefix, args.pctid_bin_width, pairs_params)
+    if pairs.is_current:
+        pairs.load()
+    else:
+        build_pair_table(db, pairs, args.min_pctid, args.max_hits,
+                         args.num_threads)
+
+    pctid_vals = list(pctid_range(args.min_pctid)) * args.num_ani
+
+    # Set seed again
+    random.seed(args.seed + 1)
+    app = StackebrandtApp(db, ani_dir=args.ani_dir)
+    app.threads = args.num_threads
+    for result in sample_pair_anis(app, pairs, pctid_vals, args.max_tries):
+        args.output_file.write(result.format_output())
+        args.output_file.flush()
+
+def sample_pair_anis(app, pairs, pctid_vals, max_tries=10):
+    # One result for each percent ID, from the first sampled pair for which
+    # ANI could be calculated
+    db = app.db
+    for current_pctid in pctid_vals:
+        if pairs.count(current_pctid) == 0:
+            print("No pairs found at", current_pctid)
+            continue
+        for trial in range(max_tries):
+            pair = pairs.sample(current_pctid)
+            query_seqid = pair["qseqid"]
+            subject_seqid = pair["sseqid"]
+            query_accession = db.seqid_accessions[query_seqid]
+            subject_accession = db.seqid_accessions[subject_seqid]
+            try:
+                ani_result, = app.calculate_ani(
+                    query_accession, [subject_accession])
+            except Exception as e:
+                print(e)
+                continue
+            yield AppResult(
+                query_accession, subject_accession, query_seqid,
+                subject_seqid, pair, ani_result)
+            break
+
+def build_pair_table(db, pairs, min_pctid, max_hits, threads=None):
+    representative_fp = pairs.prefix + "_representative.fasta"
+    representative_seqids = set()
+    for accession, seqids in db.accession_seqids.items():
+        seqids = [seqid for seqid in seqids if db.is_screened(seqid)]
+        if seqids:
+            representative_seqids.add(random.choice(seqids))
+    excluded = set(db.seqs.keys()) - representative_seqids
+    db.save_filtered_seqs(representative_fp, excluded)
+
+    # Alignments for all pairs are reported in compact form
+    aligner = PctidAligner(representative_fp, compact=True)
+    hits_fp = aligner.search(
+        representative_fp, pairs.prefix + "_hits.txt", min_pctid=min_pctid,
+        max_hits=max_hits, threads=threads)
+    with open(hits_fp) as f:
+        pairs.build(score_compact_hits(aligner.parse(f), db.seqs))
+    return pairs
+
+def pctid_range(min_pctid):
+    assert 50.0 < min_pctid <= 100.0
+    current_val = 100.0
+    while current_val > min_pctid:
+        yield current_val
+        current_val = round(current_val - 0.1, 1)
+
+
+if __name__ == "__main__":
+    main_train_soft_threshold()
@@ -1,8 +1,13 @@
 import collections
 import os
+import random
+import threading
 
 from stackebrandtcurves.refseq import RefSeq
-from stackebrandtcurves.application import StackebrandtApp
+from stackebrandtcurves.application import (
+    StackebrandtApp, QueryPlan, parse_prefetch,
+)
+from stackebrandtcurves.search import HitTable
 
 DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
 
@@ -62,6 +67,66 @@ def test_exhaustive_search():
     assert observed_pctids == EXPECTED_PCTIDS
 
 
+def test_run_many():
+    app = StackebrandtApp(refseq)
+    def run(query_accession, rng=None):
+        yield query_accession, rng.random()
+    app.run = run
+
+    results = app.run_many(["GCF_1", "GCF_2", "GCF_3"], max_workers=2, seed=5)
+    expected = random.Random(5).random()
+    assert results == {
+        "GCF_1": [("GCF_1", expected)],
+        "GCF_2": [("GCF_2", expected)],
+        "GCF_3": [("GCF_3", expected)],
+    }
+
+def test_plan_download_sizes(monkeypatch):
+    app = StackebrandtApp(refseq)
+    subject_seqids = [
+        refseq.accession_seqids[a][0]
+        for a in ["GCF_002201515.1", "GCF_004803695.1"]]
+    hits = HitTable.from_hits([
+        {'qseqid': 'q1', 'sseqid': s, 'pident': 99.0}
+        for s in subject_seqids])
+    monkeypatch.setattr(app, "search", lambda accession, rng=None: hits)
+
+    # Each request waits for the others, so they must run at the same time
+    barrier = threading.Barrier(3, timeout=5)
+    def genome_download_size(accession):
+        barrier.wait()
+        return len(accession)
+    monkeypatch.setattr(refseq, "genome_download_size", genome_download_size)
+
+    plan = app.plan("GCF_001688845.2")
+    assert plan.download_sizes == {
+        "GCF_001688845.2": 15, "GCF_002201515.1": 15, "GCF_004803695.1": 15}
+
+def test_query_plan():
+    hits = HitTable.from_hits([
+        {'qseqid': 'q1', 'sseqid': 's1', 'pident': 99.0},
+        {'qseqid': 'q1', 'sseqid': 's2', 'pident': 98.0},
+        {'qseqid': 'q1', 'sseqid': 's3', 'pident': 97.0},
+    ])
+    plan = QueryPlan("GCF_Q", hits, ["GCF_A", "GCF_A", "GCF_B"])
+    assert plan.genomes == ["GCF_Q", "GCF_A", "GCF_B"]
+    plan.genome_urls = {a: "url_" + a for a in plan.genomes}
+    plan.genome_sizes = {"GCF_Q": 3000000}
+    plan.download_sizes = {"GCF_A": 1000000, "GCF_B": None}
+    assert plan.cached_genomes == ["GCF_Q"]
+    assert plan.cache_hit_ratio() == 1 / 3
+    assert plan.download_bytes() == 1000000
+    assert plan.unknown_sizes() == ["GCF_B"]
+    assert plan.ani_input_bytes() == 3000000 + 3300000
+    assert plan.ani_cpu_time() is None
+
+    plan.fingerprints = {"GCF_A": "abc", "GCF_B": "abc"}
+    assert plan.ani_subjects() == ["GCF_A"]
+
+    prefetch_lines = list(plan.format_prefetch())
+    assert prefetch_lines == ["GCF_A\turl_GCF_A\n", "GCF_B\turl_GCF_B\n"]
+    assert list(parse_prefetch(prefetch_lines)) == ["GCF_A", "GCF_B"]
+
 EXPECTED_ACCESSIONS = {
     'lcl|NZ_CP021421.1_rrna_43': 'GCF_002201515.1',
     'lcl|NZ_CP065316.1_rrna_60': 'GCF_016696845.1',
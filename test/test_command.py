@@ -11,6 +11,7 @@ def test_main(tmp_path):
         "GCF_001688845.2",
         "--output-file", str(output_fp),
         "--data-dir", DATA_DIR,
+        "--search-cache-dir", str(tmp_path / "search_cache"),
     ]
     main(args)
     with open(output_fp) as f:
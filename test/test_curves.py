@@ -0,0 +1,59 @@
+from stackebrandtcurves.application import AppResult
+from stackebrandtcurves.curves import CurveStats, aggregate_files
+
+RESULTS1 = [
+    ("GCF_1", "GCF_2", "q1", "s1", 99.74, 96.5),
+    ("GCF_1", "GCF_3", "q1", "s2", 99.71, 94.0),
+    ("GCF_1", "GCF_4", "q1", "s3", 97.25, None),
+]
+
+RESULTS2 = [
+    ("GCF_5", "GCF_6", "q2", "s4", 99.78, 98.25),
+    ("GCF_5", "GCF_7", "q2", "s5", 97.21, 80.12),
+]
+
+def write_results(fp, results):
+    with open(fp, "w") as f:
+        f.write(AppResult.output_header)
+        for vals in results:
+            vals = dict(zip(AppResult.output_fields, vals))
+            if vals["ani"] is None:
+                vals.update(ani="", fragments_aligned="", fragments_total="")
+            else:
+                vals.update(fragments_aligned=10, fragments_total=12)
+            f.write(AppResult.format_dict(vals))
+    return fp
+
+def test_curve_stats():
+    stats = CurveStats(0.1, [95.0, 97.0])
+    for vals in RESULTS1 + RESULTS2:
+        stats.add(vals[4], vals[5])
+    rows = list(stats.rows([0.5]))
+    assert rows == [
+        {"pctid_bin": 97.2, "pairs": 2, "ani_pairs": 1, "ani_q50": 80.12,
+         "frac_ani_95": 0.0, "frac_ani_97": 0.0},
+        {"pctid_bin": 99.7, "pairs": 3, "ani_pairs": 3, "ani_q50": 96.5,
+         "frac_ani_95": 0.6667, "frac_ani_97": 0.3333},
+    ]
+
+def test_ani_quantile():
+    stats = CurveStats(0.1)
+    for ani in [95.0, 96.0, 97.0, 98.0, 99.0]:
+        stats.add(99.74, ani)
+    bin_key = 997
+    assert stats.ani_quantile(bin_key, 0.25) == 96.0
+    assert stats.ani_quantile(bin_key, 0.5) == 97.0
+    assert stats.ani_quantile(bin_key, 0.95) == 99.0
+    assert stats.ani_quantile(bin_key, 0.0) == 95.0
+
+def test_aggregate_files(tmp_path):
+    fps = [
+        write_results(str(tmp_path / "results1.txt"), RESULTS1),
+        write_results(str(tmp_path / "results2.txt"), RESULTS2),
+    ]
+    stats = aggregate_files(fps, 0.1, [95.0])
+    expected = list(stats.rows())
+    assert sum(row["pairs"] for row in expected) == 5
+
+    parallel_stats = aggregate_files(fps, 0.1, [95.0], max_workers=2)
+    assert list(parallel_stats.rows()) == expected
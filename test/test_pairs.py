@@ -0,0 +1,40 @@
+import pytest
+
+from stackebrandtcurves.pairs import PairTable
+
+HITS = [
+    {"qseqid": "a", "sseqid": "b", "pident": 99.74},
+    {"qseqid": "b", "sseqid": "a", "pident": 99.74},
+    {"qseqid": "a", "sseqid": "c", "pident": 97.25},
+    {"qseqid": "c", "sseqid": "d", "pident": 97.21},
+]
+
+def test_pair_table(tmp_path):
+    pairs = PairTable(str(tmp_path / "pairs"), 0.1)
+    pairs.build(HITS)
+
+    reloaded = PairTable(str(tmp_path / "pairs"))
+    reloaded.load()
+    assert reloaded.bin_width == 0.1
+    assert reloaded.count(99.7) == 2
+    assert reloaded.count(98.0) == 0
+    assert reloaded.sample(98.0) is None
+
+    observed = sorted(
+        (p["qseqid"], p["sseqid"]) for p in reloaded.get_pairs(97.2))
+    assert observed == [("a", "c"), ("c", "d")]
+
+    pair = reloaded.sample(99.7)
+    assert pair["pident"] == 99.74
+    assert pair["qseqid"] in {"a", "b"}
+
+def test_pair_table_params(tmp_path):
+    prefix = str(tmp_path / "pairs")
+    params = {"min_pctid": 97.0, "seed": 42}
+    PairTable(prefix, 0.1, params).build(HITS)
+    assert PairTable(prefix, 0.1, dict(params)).is_current
+    assert not PairTable(prefix, 0.1, dict(params, min_pctid=95.0)).is_current
+    assert not PairTable(prefix, 0.2, params).is_current
+
+    with pytest.raises(ValueError):
+        PairTable(prefix, 0.2, params).load()
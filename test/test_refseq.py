@@ -1,7 +1,16 @@
 import collections
+import functools
+import gzip
+import http.server
+import io
 import os
+import threading
 
-from stackebrandtcurves.refseq import RefSeq, parse_desc, too_many_ambiguous_bases
+from stackebrandtcurves.refseq import (
+    RefSeq, RefseqAssembly, parse_desc, fingerprint_fasta, IndexedFasta,
+    index_fasta, AssemblyFilter,
+    is_complete, load_validators, conditional_headers, screen_seqs,
+)
 
 DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
 
@@ -38,6 +47,24 @@ def test_load_assemblies():
     assert a.accession == "GCF_001688845.2"
     assert a.bioproject == "PRJNA224116"
 
+def test_assembly_filter():
+    db = RefSeq(DATA_DIR, assembly_filter=[
+        "assembly_level=Complete Genome,Chromosome",
+        "refseq_category!=na",
+    ])
+    db.load_assemblies()
+
+    assert len(db.assemblies) == 21
+    assert db.selected_accessions == {
+        "GCF_001688845.2", "GCF_004803915.1", "GCF_004803695.1"}
+    assert db.ssu_fasta_fp != RefSeq(DATA_DIR).ssu_fasta_fp
+
+def test_assembly_filter_parse():
+    f1 = AssemblyFilter.parse(["assembly_level=Contig,Chromosome"])
+    f2 = AssemblyFilter.parse(["assembly_level=Chromosome, Contig"])
+    assert f1.key == f2.key
+    assert f1.fields == ["assembly_level"]
+
 def test_get_16S_seqs():
     db = RefSeq(DATA_DIR)
     db.load_assemblies()
@@ -57,6 +84,181 @@ def test_collect_genome():
     genome_fp = db.collect_genome("GCF_001688845.2")
     assert os.path.exists(genome_fp)
 
-def test_too_many_ambiguous_bases():
-    assert not too_many_ambiguous_bases("ACGTNNNNCGT", 4)
-    assert too_many_ambiguous_bases("ACGTNNNNCGT", 3)
+def test_screen_seqs():
+    stats = screen_seqs(["ACGTNNNNCGT", "ACRYGTN", "", "NNACGTNNN"])
+    assert stats == [(11, 4, 4), (7, 3, 1), (0, 0, 0), (9, 5, 3)]
+
+def test_search_fasta_fp(tmp_path):
+    db = RefSeq(str(tmp_path))
+    db.seqs = {"s1": "ACGTNNACGT", "s2": "ACRYKMACGT", "s3": "ACGT"}
+    db.seqid_accessions = {"s1": "GCF_1", "s2": "GCF_1", "s3": "GCF_2"}
+    db.save_seqs()
+
+    screened = RefSeq(str(tmp_path), max_ambiguous=3, min_length=5)
+    screened.reload_seqs()
+    # Stats are read when first needed for screening
+    assert screened.seq_stats is None
+    fp = screened.search_fasta_fp()
+    assert screened.seq_stats["s1"] == (10, 2, 2)
+    assert fp != screened.ssu_fasta_fp
+    seqs = IndexedFasta(fp, fp + ".fai")
+    assert dict(seqs) == {"s1": "ACGTNNACGT"}
+    seqs.close()
+    assert [os.path.basename(fp) for fp in screened.shard_fps(2)] == [
+        "refseq_16S_screen_{0}_shard1of2.fasta".format(screened.screen_key),
+        "refseq_16S_screen_{0}_shard2of2.fasta".format(screened.screen_key)]
+
+    # The full database is not changed
+    reloaded = RefSeq(str(tmp_path))
+    reloaded.reload_seqs()
+    assert reloaded.search_fasta_fp() == reloaded.ssu_fasta_fp
+    assert reloaded.seq_stats is None
+    assert dict(reloaded.seqs) == db.seqs
+
+def test_fingerprint_fasta():
+    f1 = io.BytesIO(b">contig1 a\nACGT\nacgt\n>contig2\nGGCC\n")
+    f2 = io.BytesIO(b">other2\nGGCC\n>other1 b\nACGTACGT\n")
+    f3 = io.BytesIO(b">contig1\nACGTACGA\n>contig2\nGGCC\n")
+    assert fingerprint_fasta(f1) == fingerprint_fasta(f2)
+    assert fingerprint_fasta(f1) != fingerprint_fasta(f3)
+
+def test_link_duplicate_genome(tmp_path):
+    db = RefSeq(str(tmp_path))
+    for accession in ["GCF_000000001.1", "GCA_000000001.1"]:
+        db.assemblies[accession] = RefseqAssembly(
+            accession, "https://example.com/{0}_ASM1v1".format(accession))
+    os.makedirs(db.genome_dir)
+    fp1 = db.genome_fp(db.assemblies["GCF_000000001.1"])
+    fp2 = db.genome_fp(db.assemblies["GCA_000000001.1"])
+    with open(fp1, "w") as f:
+        f.write(">NZ_CP1.1\nACGTACGT\n")
+    with open(fp2, "w") as f:
+        f.write(">CP1.1\nACGT\nACGT\n")
+
+    assert db.genome_fingerprint("GCF_000000001.1") == \
+        db.genome_fingerprint("GCA_000000001.1")
+    assert db.link_duplicate_genome("GCA_000000001.1") == fp1
+    assert os.path.samefile(fp1, fp2)
+
+    reloaded = RefSeq(str(tmp_path))
+    assert reloaded.load_fingerprints() == db.fingerprints
+
+def test_indexed_fasta(tmp_path):
+    fasta_fp = str(tmp_path / "seqs.fasta")
+    with open(fasta_fp, "w") as f:
+        f.write(">a desc\nACGTA\nCG\n>b\nTTTT\n>c\n")
+    index_fp = index_fasta(fasta_fp, fasta_fp + ".fai")
+    seqs = IndexedFasta(fasta_fp, index_fp)
+    assert dict(seqs) == {"a": "ACGTACG", "b": "TTTT", "c": ""}
+    seqs.close()
+
+def test_save_seqs_index(tmp_path):
+    db = RefSeq(str(tmp_path))
+    db.seqs = {"s1": "ACGT", "s2": "GGGCCC"}
+    db.seqid_accessions = {"s1": "GCF_1", "s2": "GCF_2"}
+    db.save_seqs()
+
+    reloaded = RefSeq(str(tmp_path))
+    reloaded.reload_seqs()
+    assert isinstance(reloaded.seqs, IndexedFasta)
+    assert reloaded.seqs["s2"] == "GGGCCC"
+    assert dict(reloaded.seqs) == db.seqs
+
+def test_shard_fps(tmp_path):
+    db = RefSeq(str(tmp_path))
+    db.seqs = {"s1": "ACGT", "s2": "GGGCCC", "s3": "TTAA"}
+    db.seqid_accessions = {"s1": "GCF_1", "s2": "GCF_2", "s3": "GCF_3"}
+    db.save_seqs()
+
+    shard_fps = db.shard_fps(2)
+    assert [os.path.basename(fp) for fp in shard_fps] == [
+        "refseq_16S_shard1of2.fasta", "refseq_16S_shard2of2.fasta"]
+    shard_seqs = {}
+    for fp in shard_fps:
+        seqs = IndexedFasta(fp, fp + ".fai")
+        shard_seqs.update(seqs)
+        seqs.close()
+    assert shard_seqs == db.seqs
+
+def test_taxon_db(tmp_path):
+    taxonomy_dir = tmp_path / "taxonomy"
+    taxonomy_dir.mkdir()
+    (taxonomy_dir / "nodes.dmp").write_text(
+        "1\t|\t1\t|\tno rank\t|\n"
+        "10\t|\t1\t|\torder\t|\n"
+        "11\t|\t10\t|\tspecies\t|\n"
+        "20\t|\t1\t|\torder\t|\n"
+        "21\t|\t20\t|\tspecies\t|\n")
+
+    db = RefSeq(str(tmp_path), taxonomy_dir=str(taxonomy_dir))
+    taxids = {"GCF_1": "11", "GCF_2": "21", "GCF_3": "11"}
+    for accession, taxid in taxids.items():
+        db.assemblies[accession] = RefseqAssembly(
+            accession, "ftp_path", taxid=taxid, species_taxid=taxid)
+    db.selected_accessions = set(db.assemblies)
+    db.seqs = {"s1": "ACGT", "s2": "GGGCCC", "s3": "TTAA"}
+    db.seqid_accessions = {"s1": "GCF_1", "s2": "GCF_2", "s3": "GCF_3"}
+    for seqid, accession in db.seqid_accessions.items():
+        db.accession_seqids[accession].append(seqid)
+    db.save_seqs()
+
+    assert db.rank_taxids("GCF_2", "order") == [20]
+    fp = db.taxon_db([10])
+    assert fp != db.ssu_fasta_fp
+    seqs = IndexedFasta(fp, fp + ".fai")
+    assert dict(seqs) == {"s1": "ACGT", "s3": "TTAA"}
+    seqs.close()
+    assert db.taxon_db([10, 20]) == db.ssu_fasta_fp
+
+def test_read_summary(tmp_path):
+    summary_gz = tmp_path / "assembly_summary.txt.gz"
+    with open(os.path.join(DATA_DIR, "assembly_summary.txt"), "rb") as f:
+        summary_bytes = f.read()
+    summary_gz.write_bytes(gzip.compress(summary_bytes))
+
+    db = RefSeq(str(tmp_path / "data"))
+    db.summary_url = summary_gz.as_uri()
+    assemblies = db.load_assemblies()
+    assert "GCF_001688845.2" in assemblies
+    with open(db.assembly_summary_fp, "rb") as f:
+        assert f.read() == summary_bytes
+    validators = load_validators(db.summary_validators_fp)
+    assert "Last-Modified" in validators
+    assert conditional_headers(validators) == {
+        "If-Modified-Since": validators["Last-Modified"]}
+    assert sorted(os.listdir(db.data_dir)) == [
+        "assembly_summary.txt", "assembly_summary.txt.validators"]
+
+    # An interrupted download is not trusted
+    with open(db.assembly_summary_fp, "wb") as f:
+        f.write(summary_bytes[:-10])
+    assert not is_complete(db.assembly_summary_fp)
+    reloaded = RefSeq(db.data_dir)
+    reloaded.summary_url = db.summary_url
+    assert reloaded.load_assemblies().keys() == assemblies.keys()
+    assert is_complete(db.assembly_summary_fp)
+
+def test_refresh_summary(tmp_path):
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    with open(os.path.join(DATA_DIR, "assembly_summary.txt"), "rb") as f:
+        (source_dir / "assembly_summary.txt").write_bytes(f.read())
+    handler = functools.partial(
+        http.server.SimpleHTTPRequestHandler, directory=str(source_dir))
+    server = http.server.HTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        db = RefSeq(str(tmp_path / "data"))
+        db.summary_url = "http://127.0.0.1:{0}/assembly_summary.txt".format(
+            server.server_address[1])
+        db.download_summary()
+        mtime = os.path.getmtime(db.assembly_summary_fp)
+
+        # Not modified since the last download
+        db.download_summary(refresh=True)
+        assert os.path.getmtime(db.assembly_summary_fp) == mtime
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
@@ -0,0 +1,72 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from stackebrandtcurves.resources import ResourceLog, workspace
+
+def test_run(tmp_path):
+    log_fp = str(tmp_path / "resources.txt")
+    log = ResourceLog(log_fp)
+    record = log.run([sys.executable, "-c", "pass"], threads=1, input_size=10)
+    assert record["returncode"] == 0
+    assert record["wall_time"] > 0
+    assert record["max_rss_kb"] > 0
+
+    with pytest.raises(subprocess.CalledProcessError):
+        log.run([sys.executable, "-c", "raise SystemExit(3)"])
+
+    reloaded = ResourceLog(log_fp)
+    assert [r["returncode"] for r in reloaded.records] == [0, 3]
+    assert reloaded.records[0]["input_size"] == 10
+    assert list(reloaded.summary().keys()) == [record["tool"]]
+
+def make_record(threads, efficiency, input_size=1000, tool="vsearch"):
+    return {
+        "tool": tool, "threads": threads, "input_size": input_size,
+        "wall_time": 10.0, "user_time": 10.0 * threads * efficiency,
+        "sys_time": 0.0, "max_rss_kb": 100, "returncode": 0,
+    }
+
+def test_choose_threads():
+    log = ResourceLog()
+    assert log.choose_threads("vsearch", 1000, max_threads=16) == 16
+
+    log.records = [
+        make_record(2, 0.95), make_record(4, 0.8), make_record(8, 0.3)]
+    assert log.choose_threads("vsearch", 1000, max_threads=16) == 4
+    # No history for inputs of very different size
+    assert log.choose_threads("vsearch", 10 ** 6, max_threads=16) == 16
+
+    log.records = [make_record(4, 0.9)]
+    assert log.choose_threads("vsearch", 1000, max_threads=16) == 8
+
+def test_choose_threads_makeudb():
+    # Database builds always run on one thread and do not count as searches
+    log = ResourceLog()
+    log.records = [
+        make_record(1, 1.0, tool="vsearch-makeudb"), make_record(16, 0.4)]
+    assert log.choose_threads("vsearch", 1000, max_threads=16) == 8
+    log.records.append(make_record(1, 1.0, tool="vsearch-makeudb"))
+    assert log.choose_threads("vsearch", 1000, max_threads=16) == 8
+
+def test_run_tool():
+    log = ResourceLog()
+    record = log.run([sys.executable, "-c", "pass"], tool="python-noop")
+    assert record["tool"] == "python-noop"
+    assert list(log.summary().keys()) == ["python-noop"]
+
+def test_workspace(tmp_path):
+    with workspace(str(tmp_path)) as dir1, workspace(str(tmp_path)) as dir2:
+        assert dir1 != dir2
+        assert os.path.dirname(dir1) == str(tmp_path)
+    assert os.listdir(str(tmp_path)) == []
+
+def test_cpu_rate():
+    log = ResourceLog()
+    assert log.cpu_rate("vsearch") is None
+    log.records = [make_record(2, 0.5), make_record(4, 0.5, input_size=3000)]
+    # 30 s CPU over 4000 bytes
+    assert log.cpu_rate("vsearch") == 30.0 / 4000
+    assert log.cpu_rate("fastANI") is None
@@ -2,7 +2,10 @@ import collections
 import os
 
 from stackebrandtcurves.refseq import RefSeq
-from stackebrandtcurves.search import count_matches, limit_hits
+from stackebrandtcurves.search import (
+    count_matches, limit_hits, sample_hits, aggregate_hits, SearchCache,
+    score_caln, HitTable, merge_hits,
+)
 
 def test_count_matches():
     s1 = "ACGTNNY-G"
@@ -10,8 +13,153 @@ def test_count_matches():
     #     ^^^ ^^ ^^
     assert count_matches(s1, s2) == 7
 
+def test_score_caln():
+    # Full alignment, with terminal gaps:
+    #   TT--AC-GTNA--
+    #   --GGACTGAAACC
+    # Aligned segment:
+    #   AC-GTNA
+    #   ACTGAAA
+    qseq = "TTACGTNA"
+    sseq = "GGACTGAAACC"
+    assert score_caln("2D2I2MI4M2I", qseq, sseq, 3, 8, 3, 9) == (7, 5)
+    qrow = "AC-GTNA"
+    srow = "ACTGAAA"
+    assert count_matches(qrow, srow) == 5
+
+def test_score_caln_insertion_and_deletion():
+    # Alignment rows:
+    #   AC-GTAC
+    #   ACTGT-C
+    assert score_caln("2MI2MDM", "ACGTAC", "ACTGTC", 1, 6, 1, 6) == (7, 5)
+    assert count_matches("AC-GTAC", "ACTGT-C") == 5
+
+def test_score_caln_identical():
+    assert score_caln("=", "ACGT", "ACGT", 1, 4, 1, 4) == (4, 4)
+
 def test_limit_hits():
     hits = [{'pident': x} for x in [90.1, 90.1, 90.1, 90.0]]
     observed = list(limit_hits(hits, 2))
     expected = [{'pident': x} for x in [90.1, 90.1, 90.0]]
     assert observed == expected
+
+def test_sample_hits_bins():
+    hits = [
+        {'pident': x, 'sseqid': str(i)}
+        for i, x in enumerate([99.71, 99.75, 99.79, 99.6, 99.62])]
+    observed = list(sample_hits(hits, lambda s: s, 0.1, 2))
+    assert len(observed) == 4
+    assert sum(h['pident'] > 99.7 for h in observed) == 2
+
+def test_sample_hits_budget():
+    hits = [
+        {'pident': x, 'sseqid': a}
+        for x, a in [(99.5, "a"), (99.5, "b"), (98.5, "c"), (97.5, "d")]]
+    cached = {"b", "d"}
+    observed = sample_hits(
+        hits, lambda s: s, 1.0, 10, max_subjects=3,
+        max_downloads=1, is_cached=lambda a: a in cached)
+    assert [h['sseqid'] for h in observed] == ["b", "c", "d"]
+
+AGGREGATION_HITS = [
+    {'qseqid': 'q1', 'sseqid': 'a1', 'pident': 99.0},
+    {'qseqid': 'q1', 'sseqid': 'a2', 'pident': 98.0},
+    {'qseqid': 'q2', 'sseqid': 'a1', 'pident': 96.0},
+    {'qseqid': 'q2', 'sseqid': 'b1', 'pident': 95.0},
+]
+
+def test_aggregate_hits():
+    def subject_key(seqid):
+        return seqid[0]
+
+    observed = {
+        h['sseqid'][0]: (h['sseqid'], h['pident'])
+        for h in aggregate_hits(AGGREGATION_HITS, subject_key, "max")}
+    assert observed == {'a': ('a1', 99.0), 'b': ('b1', 95.0)}
+
+    observed = {
+        h['sseqid'][0]: round(h['pident'], 3)
+        for h in aggregate_hits(AGGREGATION_HITS, subject_key, "mean")}
+    assert observed == {'a': 97.667, 'b': 95.0}
+
+    observed = {
+        h['sseqid'][0]: h['pident']
+        for h in aggregate_hits(AGGREGATION_HITS, subject_key, "best-copy")}
+    assert observed == {'a': 97.5, 'b': 95.0}
+
+def test_search_cache(tmp_path):
+    subject_fp = tmp_path / "subject.fasta"
+    subject_fp.write_text(">s1\nACGT\n")
+    cache = SearchCache(str(tmp_path / "cache"))
+    key = cache.key([("q1", "ACGT")], str(subject_fp))
+    assert cache.get(key, 90.0, 10) is None
+
+    hits = [
+        {'qseqid': 'q1', 'sseqid': s, 'vsearch_pident': v, 'pident': p}
+        for s, v, p in [("s1", 99.5, 99.6), ("s2", 97.0, 97.1),
+                        ("s3", 95.0, 95.2)]]
+    cache.put(key, 90.0, 10, hits, {"q1": 3})
+    assert [dict(h) for h in cache.get(key, 90.0, 10)] == hits
+    assert [dict(h) for h in cache.get(key, 96.0, 10)] == hits[:2]
+    assert [dict(h) for h in cache.get(key, 90.0, 1)] == hits[:1]
+    assert cache.get(key, 85.0, 10) is None
+    assert cache.get(key, 90.0, 20) is None
+
+    # Search stopped at max_hits, so a higher minimum may miss hits
+    cache.put(key, 90.0, 3, hits, {"q1": 3})
+    assert cache.get(key, 96.0, 3) is None
+    assert [dict(h) for h in cache.get(key, 96.0, 2)] == hits[:2]
+
+    # The self-hit was removed, but still counts towards max_hits
+    cache.put(key, 90.0, 3, hits[:2], {"q1": 3})
+    assert cache.get(key, 98.0, 2) is None
+    assert [dict(h) for h in cache.get(key, 90.0, 3)] == hits[:2]
+
+def test_search_cache_queries(tmp_path):
+    subject_fp = tmp_path / "subject.fasta"
+    subject_fp.write_text(">s1\nACGT\n")
+    cache = SearchCache(str(tmp_path / "cache"))
+    key = cache.key([("q1", "ACGT"), ("q2", "ACGA")], str(subject_fp))
+
+    # max_hits applies to each query separately
+    hits = [
+        {'qseqid': q, 'sseqid': s, 'vsearch_pident': v, 'pident': v}
+        for q in ["q1", "q2"]
+        for s, v in [("s1", 99.5), ("s2", 97.0), ("s3", 95.0)]]
+    cache.put(key, 90.0, 3, hits, {"q1": 3, "q2": 3})
+    assert [dict(h) for h in cache.get(key, 90.0, 3)] == hits
+    assert [dict(h) for h in cache.get(key, 90.0, 2)] == (
+        hits[0:2] + hits[3:5])
+    assert cache.get(key, 96.0, 3) is None
+
+def test_hit_table():
+    hits = HitTable.from_hits([
+        {'qseqid': 'q1', 'sseqid': 's1', 'vsearch_pident': 99.0, 'pident': 99.5},
+        {'qseqid': 'q1', 'sseqid': 's2', 'vsearch_pident': 98.0, 'pident': 98.0},
+        {'qseqid': 'q2', 'sseqid': 's1', 'pident': 97.0},
+    ])
+    assert len(hits) == 3
+    assert hits.seqids == ['q1', 's1', 's2', 'q2']
+    assert hits.column("sseqid") == ['s1', 's2', 's1']
+    assert hits[2]['vsearch_pident'] == 97.0
+    assert dict(hits[0]) == {
+        'qseqid': 'q1', 'sseqid': 's1', 'vsearch_pident': 99.0,
+        'pident': 99.5}
+
+    subset = hits.subset([2, 0])
+    assert list(subset.pidents) == [97.0, 99.5]
+    subset.extend(hits.subset([1]))
+    assert subset.column("sseqid") == ['s1', 's1', 's2']
+
+def test_merge_hits():
+    shard1 = HitTable.from_hits([
+        {'qseqid': 'q1', 'sseqid': 's1', 'pident': 97.0},
+        {'qseqid': 'q2', 'sseqid': 's1', 'pident': 96.0},
+    ])
+    shard2 = HitTable.from_hits([
+        {'qseqid': 'q1', 'sseqid': 's2', 'pident': 99.0},
+        {'qseqid': 'q1', 'sseqid': 's3', 'pident': 97.0},
+    ])
+    hits = merge_hits([shard1, shard2], 2)
+    assert [(h['qseqid'], h['sseqid']) for h in hits] == [
+        ('q1', 's2'), ('q1', 's1'), ('q2', 's1')]
@@ -0,0 +1,45 @@
+import collections
+import threading
+
+import pytest
+
+from stackebrandtcurves.application import AppResult
+from stackebrandtcurves.server import QueryServer, query_server
+
+MockDb = collections.namedtuple("MockDb", ["assemblies", "seqs"])
+
+class MockApp:
+    def __init__(self):
+        self.db = MockDb({}, {})
+        self.min_pctid = 90.0
+
+    def run(self, query_accession, rng=None):
+        if query_accession == "bad":
+            raise KeyError(query_accession)
+        yield AppResult(
+            query_accession, "GCF_2", "q1", "s1", {"pident": 99.123},
+            {"ani": 98.5, "fragments_aligned": 10, "fragments_total": 12})
+        yield AppResult(
+            query_accession, "GCF_3", "q1", "s2", {"pident": self.min_pctid},
+            None)
+
+def test_query_server():
+    server = QueryServer(("127.0.0.1", 0), MockApp())
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        url = "http://127.0.0.1:{0}".format(server.server_port)
+        results = list(query_server(url, "GCF_1", {"min_pctid": 95.0}))
+        with pytest.raises(RuntimeError):
+            list(query_server(url, "bad"))
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+    assert [r["subject_assembly"] for r in results] == ["GCF_2", "GCF_3"]
+    assert results[0]["pctid"] == 99.12
+    assert results[1]["pctid"] == 95.0
+    assert AppResult.format_dict(results[1]) == "GCF_1\tGCF_3\tq1\ts2\t95.0\t\t\t\n"
+    # Options from one query are not kept for the next one
+    assert server.app.min_pctid == 90.0
@@ -0,0 +1,31 @@
+import io
+
+from stackebrandtcurves.taxonomy import Taxonomy, parse_dmp
+
+NODES_DMP = (
+    "1\t|\t1\t|\tno rank\t|\t\t|\n"
+    "2\t|\t1\t|\tsuperkingdom\t|\t\t|\n"
+    "10\t|\t2\t|\torder\t|\t\t|\n"
+    "11\t|\t10\t|\tfamily\t|\t\t|\n"
+    "12\t|\t11\t|\tspecies\t|\t\t|\n"
+    "20\t|\t2\t|\torder\t|\t\t|\n"
+    "21\t|\t20\t|\tspecies\t|\t\t|\n"
+)
+
+def test_parse_dmp():
+    toks = list(parse_dmp(io.StringIO("7\t|\t99\t|\n")))
+    assert toks == [["7", "99"]]
+
+def test_taxonomy():
+    taxonomy = Taxonomy()
+    for toks in parse_dmp(io.StringIO(NODES_DMP)):
+        taxonomy.add(int(toks[0]), int(toks[1]), toks[2])
+    taxonomy.merged[99] = 12
+
+    assert taxonomy.lineage(12) == [12, 11, 10, 2, 1]
+    assert taxonomy.lineage(99) == [12, 11, 10, 2, 1]
+    assert taxonomy.lineage(5) == []
+    assert taxonomy.ancestor("12", "order") == 10
+    assert taxonomy.ancestor(21, "family") is None
+    assert taxonomy.is_within(12, {10})
+    assert not taxonomy.is_within(21, {10, 11})
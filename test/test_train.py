@@ -0,0 +1,72 @@
+import os
+import random
+
+from stackebrandtcurves.application import StackebrandtApp
+from stackebrandtcurves.pairs import PairTable
+from stackebrandtcurves.refseq import RefSeq
+from stackebrandtcurves.search import PctidAligner
+from stackebrandtcurves.train import build_pair_table, sample_pair_anis
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+refseq = RefSeq(DATA_DIR)
+refseq.load()
+
+def read_seqids(fasta_fp):
+    with open(fasta_fp) as f:
+        return [line[1:].strip() for line in f if line.startswith(">")]
+
+def test_build_pair_table(tmp_path, monkeypatch):
+    def fake_search(self, input_fp, hits_fp, **kwargs):
+        # Whole-sequence alignments between the first three representatives,
+        # plus a self-hit
+        r0, r1, r2 = read_seqids(input_fp)[:3]
+        with open(hits_fp, "w") as f:
+            for q, s in [(r0, r0), (r0, r1), (r1, r0), (r0, r2)]:
+                qlen = len(refseq.seqs[q])
+                slen = len(refseq.seqs[s])
+                f.write("{0}\t{1}\t99.0\t=\t1\t{2}\t1\t{3}\n".format(
+                    q, s, qlen, slen))
+        return hits_fp
+    monkeypatch.setattr(PctidAligner, "search", fake_search)
+
+    random.seed(42)
+    pairs = PairTable(str(tmp_path / "pairs"), 0.1, {"seed": 42})
+    build_pair_table(refseq, pairs, 97.0, 100)
+
+    # One representative sequence from each assembly
+    representative_seqids = read_seqids(pairs.prefix + "_representative.fasta")
+    accessions = [refseq.seqid_accessions[s] for s in representative_seqids]
+    assert sorted(accessions) == sorted(
+        a for a, seqids in refseq.accession_seqids.items() if seqids)
+
+    reloaded = PairTable(str(tmp_path / "pairs"), 0.1, {"seed": 42})
+    reloaded.load()
+    assert sum(count for offset, count in reloaded.bins.values()) == 3
+    assert set(reloaded.seqids) == set(representative_seqids[:3])
+
+def test_sample_pair_anis(tmp_path, monkeypatch):
+    seqid1, seqid2 = refseq.accession_seqids["GCF_001688845.2"][:1] + \
+        refseq.accession_seqids["GCF_002201515.1"][:1]
+    pairs = PairTable(str(tmp_path / "pairs"), 0.1)
+    pairs.build([
+        {"qseqid": seqid1, "sseqid": seqid2, "pident": 99.74},
+        {"qseqid": seqid2, "sseqid": seqid1, "pident": 98.51},
+    ])
+
+    app = StackebrandtApp(refseq)
+    calls = []
+    def fake_calculate_ani(query_accession, subject_accessions):
+        calls.append((query_accession, subject_accessions))
+        # The first try fails, and another pair is sampled
+        if len(calls) == 1:
+            raise ValueError("No genome")
+        return [{"ani": 96.5}]
+    monkeypatch.setattr(app, "calculate_ani", fake_calculate_ani)
+
+    results = list(sample_pair_anis(app, pairs, [99.7, 99.0, 98.5]))
+    assert len(calls) == 3
+    assert [r.hit["pident"] for r in results] == [99.74, 98.51]
+    assert results[1].query_seqid == seqid2
+    assert results[1].subject_accession == "GCF_001688845.2"
+    assert results[1].ani_result == {"ani": 96.5}